@@ -1,5 +1,21 @@
-import re, tldextract, requests
+import re, tldextract, requests, hashlib, threading
+from bisect import bisect_right
+from collections import OrderedDict
+from functools import lru_cache
 from html import unescape
+from itertools import accumulate
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+
+try:
+    import ahocorasick  # optional C automaton for the keyword scan
+except ImportError:
+    ahocorasick = None
+
+try:
+    from selectolax.lexbor import LexborHTMLParser  # optional single-pass HTML text extractor
+except ImportError:
+    LexborHTMLParser = None
 
 CATEGORIES = [
     "Advertising",
@@ -53,22 +69,90 @@ KEYWORDS = {
 
 }
 
-def _fetch_html(url: str, timeout=3):
+# Token slots in classify: 0 = url, 1 = host, 2 = domain, 3 = page text
+_URL_TOK, _DOMAIN_TOK = 0, 2
+
+# Special-case rules scored in the same scan as the keywords:
+# (category, pattern, weight, only in token, rule group — a group fires at most once)
+_RULES = [
+    ("General / Education", "edu", 3, _DOMAIN_TOK, "edu"),
+    ("Blogs", "wp-login", 1, _URL_TOK, "wp"),
+    ("Blogs", "/wp-content/", 1, _URL_TOK, "wp"),
+]
+
+# Static pattern index, lowered once at import. Keywords score once per token they appear in.
+_KW_FLAT = [(c, k.lower(), 1, None, None) for c, ks in KEYWORDS.items() for k in ks] + _RULES
+_CATS = tuple(CATEGORIES)
+
+def _build_automaton():
+    """One Aho-Corasick automaton over every pattern: value is (pattern, [_KW_FLAT indexes])."""
+    if ahocorasick is None:
+        return None
+    A = ahocorasick.Automaton()
+    for i, (_, pat, _, _, _) in enumerate(_KW_FLAT):
+        if pat in A:
+            A.get(pat)[1].append(i)
+        else:
+            A.add_word(pat, (pat, [i]))
+    A.make_automaton()
+    return A
+
+_AUTOMATON = _build_automaton()
+
+# Fallback scan when pyahocorasick is missing: one regex alternation, longest pattern first,
+# inside a lookahead so every start offset is tried in C. Whatever pattern is longest at an
+# offset implies every pattern it contains, so the pair recovers the full set of hits.
+_PATS = sorted({pat for _, pat, _, _, _ in _KW_FLAT}, key=len, reverse=True)
+_KW_RE = re.compile("(?=(" + "|".join(map(re.escape, _PATS)) + "))")
+_SUBPATS = {p: frozenset(q for q in _PATS if q in p) for p in _PATS}
+
+_SCRIPT_RE = re.compile(r"<script.*?</script>", re.I | re.S)
+_STYLE_RE = re.compile(r"<style.*?</style>", re.I | re.S)
+_TAG_RE = re.compile(r"<[^>]+>")
+_WS_RE = re.compile(r"\s+")
+
+@lru_cache(maxsize=4096)
+def _extract(netloc: str):
+    """Public-suffix split, memoized per netloc (hosts repeat constantly from the extension)."""
+    return tldextract.extract(netloc)
+
+# Pooled keep-alive connections so repeat hosts skip the TCP/TLS handshake
+_SESSION = requests.Session()
+_SESSION.headers["User-Agent"] = "Mozilla/5.0"
+_SESSION.mount("http://", HTTPAdapter(pool_connections=32, pool_maxsize=64))
+_SESSION.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=64))
+
+# Keyword signals saturate early; bounding the haystack bounds worst-case strip/scan cost
+_MAX_HTML = 256 * 1024
+
+def _fetch_html(url: str, timeout=3, max_bytes=_MAX_HTML):
     try:
-        r = requests.get(url, timeout=timeout, headers={"User-Agent":"Mozilla/5.0"})
-        if r.ok and "text" in r.headers.get("Content-Type",""):
-            return r.text
+        with _SESSION.get(url, timeout=timeout, stream=True) as r:
+            if not (r.ok and "text" in r.headers.get("Content-Type","")):
+                return ""
+            # Long pages add nothing to the keyword signal; stop reading at the cap
+            buf = bytearray()
+            for chunk in r.iter_content(65536):
+                buf += chunk
+                if len(buf) >= max_bytes:
+                    break
+            return bytes(buf[:max_bytes]).decode(r.encoding or "utf-8", errors="replace")
     except Exception:
         return ""
-    return ""
 
 def _textify(html: str):
     if not html: return ""
-    txt = re.sub(r"<script[\s\S]*?</script>", " ", html, flags=re.I)
-    txt = re.sub(r"<style[\s\S]*?</style>", " ", txt, flags=re.I)
-    txt = re.sub(r"<[^>]+>", " ", txt)
-    txt = unescape(txt)
-    txt = re.sub(r"\s+", " ", txt).strip().lower()
+    if LexborHTMLParser is not None:
+        # One streaming parse instead of three regex passes; entities are decoded by the parser
+        tree = LexborHTMLParser(html)
+        tree.strip_tags(["script", "style"])
+        txt = tree.text(separator=" ")
+    else:
+        txt = _SCRIPT_RE.sub(" ", html)
+        txt = _STYLE_RE.sub(" ", txt)
+        txt = _TAG_RE.sub(" ", txt)
+        txt = unescape(txt)
+    txt = _WS_RE.sub(" ", txt).strip().lower()
     return txt
 
 def classify(url: str, html: str = None):
@@ -77,36 +161,89 @@ def classify(url: str, html: str = None):
     """
     if not (url or "").startswith(("http://","https://")):
         url = "https://" + (url or "")
-    ext = tldextract.extract(url)
+    try:
+        netloc = urlsplit(url).netloc
+    except ValueError:
+        netloc = url
+    ext = _extract(netloc)
     domain = ".".join([p for p in [ext.domain, ext.suffix] if p])
     host = ".".join([p for p in [ext.subdomain, ext.domain, ext.suffix] if p if p])
 
     tokens = [url.lower(), host.lower(), domain.lower()]
-    body = _textify(html) if html else _textify(_fetch_html(url))
+    body = _textify((html or _fetch_html(url))[:_MAX_HTML])
     if body:
         tokens.append(body)
 
-    scores = {c: 0 for c in CATEGORIES}
-    for cat, kws in KEYWORDS.items():
-        for kw in kws:
-            pat = kw.lower()
-            for t in tokens:
-                if pat in t:
-                    scores[cat] += 1
-
-    # Special-case rules
-    if any(s in domain for s in ["edu",".edu"]): scores["General / Education"] += 3
-    if any(s in url for s in ["wp-login","/wp-content/"]): scores["Blogs"] += 1
+    scores = dict.fromkeys(_CATS, 0)
+    total = 0
+    # "\n" keeps matches from spanning tokens
+    hay = "\n".join(tokens)
+    if _AUTOMATON is not None:
+        # Single trie walk over the whole haystack; token index recovered from the match offset
+        ends = list(accumulate(len(t) + 1 for t in tokens))
+        seen = set()
+        for end, (_, idxs) in _AUTOMATON.iter(hay):
+            tok = bisect_right(ends, end)
+            for i in idxs:
+                cat, _, weight, only, group = _KW_FLAT[i]
+                if only is not None and only != tok:
+                    continue
+                key = group or (tok, i)
+                if key in seen:
+                    continue
+                seen.add(key)
+                scores[cat] += weight
+                total += weight
+    else:
+        # One regex pass finds which patterns occur; only those are re-counted per token.
+        present = set()
+        for p in {m.group(1) for m in _KW_RE.finditer(hay)}:
+            present |= _SUBPATS[p]
+        fired = set()
+        for cat, pat, weight, only, group in _KW_FLAT:
+            if pat not in present:
+                continue
+            toks = tokens if only is None else tokens[only:only + 1]
+            hits = sum(1 for t in toks if pat in t)
+            if not hits:
+                continue
+            if group:
+                if group in fired:
+                    continue
+                fired.add(group)
+                hits = 1
+            scores[cat] += weight * hits
+            total += weight * hits
 
     # ✅ Prioritize Allow only
     if scores["Allow only"] > 0:
         best_cat = "Allow only"
     else:
-        best_cat = max(scores, key=lambda c: scores[c])
+        # dict order == CATEGORIES order, so ties still go to the first category
+        best_cat = max(scores, key=scores.__getitem__)
         if scores[best_cat] == 0:
             best_cat = "Uncategorized"
 
-    total = sum(scores.values()) or 1
-    conf = scores[best_cat] / total
+    conf = scores[best_cat] / (total or 1)
     return {"category": best_cat, "confidence": float(conf), "domain": domain, "host": host}
 
+
+_CLASSIFY_CACHE = OrderedDict()
+_CLASSIFY_CACHE_MAX = 16384
+_CLASSIFY_LOCK = threading.Lock()
+
+def classify_cached(url: str, html: str = None):
+    """classify() memoized by (url, blake2b(html)) in a bounded LRU; repeat URLs skip fetch + scan."""
+    digest = hashlib.blake2b(html.encode("utf-8", "replace"), digest_size=16).digest() if html else None
+    key = (url, digest)
+    with _CLASSIFY_LOCK:
+        hit = _CLASSIFY_CACHE.get(key)
+        if hit is not None:
+            _CLASSIFY_CACHE.move_to_end(key)
+            return dict(hit)
+    result = classify(url, html)
+    with _CLASSIFY_LOCK:
+        _CLASSIFY_CACHE[key] = result
+        if len(_CLASSIFY_CACHE) > _CLASSIFY_CACHE_MAX:
+            _CLASSIFY_CACHE.popitem(last=False)
+    return dict(result)
@@ -1,16 +1,56 @@
-from flask import Blueprint, request, jsonify
-import sqlite3, os, json, time
-from ai_classifier import classify, CATEGORIES
+from flask import Blueprint, request, jsonify, session
+import sqlite3, os, json, time, threading
+from concurrent.futures import ThreadPoolExecutor
+from ai_classifier import classify_cached, CATEGORIES
+
+try:
+    import orjson  # optional faster JSON for settings/schedule blobs
+    def _jloads(s):
+        return orjson.loads(s)
+    def _jdumps(v):
+        return orjson.dumps(v).decode()
+except ImportError:
+    _jloads, _jdumps = json.loads, json.dumps
 
 ROOT = os.path.dirname(__file__)
 DB_PATH = os.path.join(ROOT, "gschool.db")
 
 ai = Blueprint("ai", __name__, url_prefix="/api/ai")
 
+def _body():
+    """Request JSON, or {} when missing or malformed."""
+    return request.get_json(force=True, silent=True) or {}
+
+_tls = threading.local()
+
 def _db():
-    return sqlite3.connect(DB_PATH)
+    """One long-lived connection per thread; `with _db() as conn` scopes a transaction."""
+    conn = getattr(_tls, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+        conn.executescript(
+            "PRAGMA journal_mode=WAL;"
+            "PRAGMA synchronous=NORMAL;"
+            "PRAGMA temp_store=MEMORY;"
+            "PRAGMA mmap_size=268435456;"
+        )
+        _tls.conn = conn
+    return conn
+
+_schema_lock = threading.Lock()
+_schema_ready = False
 
 def ensure_schema():
+    global _schema_ready
+    if _schema_ready:
+        return
+    with _schema_lock:
+        if _schema_ready:
+            return
+        _create_schema()
+        _schema_ready = True
+
+def _create_schema():
     with _db() as conn:
         cur = conn.cursor()
         # Tables
@@ -27,6 +67,7 @@ def ensure_schema():
             k TEXT PRIMARY KEY,
             v TEXT
         )""")
+        cur.execute("CREATE TABLE IF NOT EXISTS overrides (k TEXT PRIMARY KEY, v TEXT)")
         cur.execute("""CREATE TABLE IF NOT EXISTS chat_messages(
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             room TEXT,
@@ -46,6 +87,36 @@ def ensure_schema():
         conn.commit()
 
 
+@ai.record_once
+def _on_register(state):
+    # Schema is created once when the blueprint is registered, not per request
+    ensure_schema()
+
+
+def _parse_hhmm(val, default_h, default_m):
+    if not val:
+        return default_h, default_m
+    try:
+        parts = str(val).split(":", 1)
+        h = int(parts[0])
+        m = int(parts[1]) if len(parts) > 1 else 0
+        h = max(0, min(23, h))
+        m = max(0, min(59, m))
+        return h, m
+    except Exception:
+        return default_h, default_m
+
+def _normalize_schedule(sched):
+    """Store minute-of-day ints next to the "HH:MM" strings so checks skip string parsing."""
+    if not isinstance(sched, dict):
+        return sched
+    sched = dict(sched)
+    sh, sm = _parse_hhmm(sched.get("start"), 0, 0)
+    eh, em = _parse_hhmm(sched.get("end"), 23, 59)
+    sched["start_min"] = sh * 60 + sm
+    sched["end_min"] = eh * 60 + em
+    return sched
+
 def _is_schedule_active(sched, now_ts=None):
     """
     Simple helper to decide if a schedule is currently "active".
@@ -54,7 +125,9 @@ def _is_schedule_active(sched, now_ts=None):
         "enabled": bool,
         "start": "HH:MM",   # optional, default "00:00"
         "end": "HH:MM",     # optional, default "23:59"
-        "weekdays_only": bool
+        "weekdays_only": bool,
+        "start_min": int,   # precomputed by _normalize_schedule, when saved
+        "end_min": int
       }
     """
     if not isinstance(sched, dict):
@@ -70,25 +143,16 @@ def _is_schedule_active(sched, now_ts=None):
     if sched.get("weekdays_only") and lt.tm_wday >= 5:
         return False
 
-    def _parse_hhmm(val, default_h, default_m):
-        if not val:
-            return default_h, default_m
-        try:
-            parts = str(val).split(":", 1)
-            h = int(parts[0])
-            m = int(parts[1]) if len(parts) > 1 else 0
-            h = max(0, min(23, h))
-            m = max(0, min(59, m))
-            return h, m
-        except Exception:
-            return default_h, default_m
-
-    sh, sm = _parse_hhmm(sched.get("start"), 0, 0)
-    eh, em = _parse_hhmm(sched.get("end"), 23, 59)
+    start_minutes = sched.get("start_min")
+    end_minutes = sched.get("end_min")
+    if start_minutes is None or end_minutes is None:
+        # Legacy rows saved before minutes were precomputed
+        sh, sm = _parse_hhmm(sched.get("start"), 0, 0)
+        eh, em = _parse_hhmm(sched.get("end"), 23, 59)
+        start_minutes = sh * 60 + sm
+        end_minutes = eh * 60 + em
 
     cur_minutes = lt.tm_hour * 60 + lt.tm_min
-    start_minutes = sh * 60 + sm
-    end_minutes = eh * 60 + em
 
     if start_minutes == end_minutes:
         # Degenerate case: treat as always off
@@ -101,17 +165,28 @@ def _is_schedule_active(sched, now_ts=None):
         # Window wraps past midnight (e.g. 22:00–06:00)
         return not (end_minutes <= cur_minutes < start_minutes)
 
+def _scheduled_flag(blocked, schedule_json, now_ts=None):
+    """A category's effective blocked flag: when a schedule exists, it decides."""
+    if schedule_json:
+        try:
+            sched = _jloads(schedule_json)
+        except Exception:
+            sched = None
+        if sched:
+            return bool(_is_schedule_active(sched, now_ts))
+    return bool(blocked)
+
 def get_setting(key, default=None):
     with _db() as conn:
         cur = conn.cursor()
         cur.execute("SELECT v FROM settings WHERE k=?", (key,))
         row = cur.fetchone()
-        return json.loads(row[0]) if row and row[0] else default
+        return _jloads(row[0]) if row and row[0] else default
 
 def set_setting(key, value):
     with _db() as conn:
         cur = conn.cursor()
-        cur.execute("INSERT OR REPLACE INTO settings(k,v) VALUES(?,?)", (key, json.dumps(value)))
+        cur.execute("INSERT OR REPLACE INTO settings(k,v) VALUES(?,?)", (key, _jdumps(value)))
         conn.commit()
 
 
@@ -130,12 +205,11 @@ def categories():
         "weekdays_only": bool
       }
     """
-    ensure_schema()
     with _db() as conn:
         cur = conn.cursor()
 
         if request.method == "POST":
-            body = request.json or {}
+            body = _body()
             name = body.get("name")
             if not name:
                 return jsonify({"ok": False, "error": "name required"}), 400
@@ -167,7 +241,7 @@ def categories():
             if schedule is not None:
                 cur.execute(
                     "INSERT OR REPLACE INTO category_schedules(name, schedule_json) VALUES(?,?)",
-                    (name, json.dumps(schedule)),
+                    (name, _jdumps(_normalize_schedule(schedule))),
                 )
 
             conn.commit()
@@ -196,7 +270,7 @@ def categories():
             schedule = None
             if srow and srow[0]:
                 try:
-                    schedule = json.loads(srow[0])
+                    schedule = _jloads(srow[0])
                 except Exception:
                     schedule = None
             rows.append(
@@ -206,6 +280,57 @@ def categories():
         return jsonify({"ok": True, "categories": rows})
 
 
+def _block_decision(url, result, allowlist, rows, default_redirect, now_ts):
+    """Blocked/redirect verdict for one classify result; rows maps name -> (blocked, block_url, schedule_json)."""
+    # --- Apply schedule overrides, if configured ---
+    g_blocked, _, g_sched = rows.get("Global Block All", (0, None, None))
+    global_block_on = _scheduled_flag(g_blocked, g_sched, now_ts)
+
+    c_blocked, cat_block_url, c_sched = rows.get(result["category"], (0, None, None))
+    cat_blocked = _scheduled_flag(c_blocked, c_sched, now_ts)
+
+    # --- Handle Global Block All Mode (unchanged, except schedule support) ---
+    allowed_domains = ["blocked.gdistrict.org"]
+    if global_block_on:
+        # Check if URL is in allowlist or allowed domains (url lowered once, not per entry)
+        url_lc = url.lower()
+        allowed = any(a.lower() in url_lc for a in allowlist + allowed_domains)
+        if not allowed:
+            return {
+                "ok": True,
+                "url": url,
+                "result": result,
+                "blocked": True,
+                "block_url": default_redirect,
+            }
+
+    # --- Normal AI blocking with (maybe) scheduled flag ---
+    blocked = cat_blocked
+    final_block_url = cat_block_url or default_redirect
+
+    return {
+        "ok": True,
+        "url": url,
+        "result": result,
+        "blocked": blocked,
+        "block_url": final_block_url,
+    }
+
+def _load_block_rules(cur, names=None):
+    """Global allowlist plus (blocked, block_url, schedule_json) per category, optionally limited to names."""
+    cur.execute("SELECT v FROM overrides WHERE k='allowlist'")
+    row = cur.fetchone()
+    allowlist = _jloads(row[0]) if row and row[0] else []
+
+    sql = """SELECT c.name, c.blocked, c.block_url, s.schedule_json
+             FROM categories c LEFT JOIN category_schedules s ON s.name = c.name"""
+    if names:
+        cur.execute(sql + " WHERE c.name IN (%s)" % ",".join("?" * len(names)), tuple(names))
+    else:
+        cur.execute(sql)
+    rows = {n: (b, u, sj) for (n, b, u, sj) in cur.fetchall()}
+    return allowlist, rows
+
 @ai.route("/classify", methods=["POST"])
 def api_classify():
     """
@@ -215,11 +340,10 @@ def api_classify():
       - Optional time-based schedules for each category, and for the
         special "Global Block All" category.
     """
-    ensure_schema()
-    body = request.json or {}
+    body = _body()
     url = body.get("url") or ""
     html = body.get("html")
-    result = classify(url, html)
+    result = classify_cached(url, html)
 
     # --- Load settings ---
     default_redirect = get_setting(
@@ -228,105 +352,70 @@ def api_classify():
     )
 
     with _db() as conn:
-        cur = conn.cursor()
-
-        # Get global allowlist (unchanged behavior)
-        cur.execute("CREATE TABLE IF NOT EXISTS overrides (k TEXT PRIMARY KEY, v TEXT)")
-        conn.commit()
-        cur.execute("SELECT v FROM overrides WHERE k='allowlist'")
-        row = cur.fetchone()
-        allowlist = json.loads(row[0]) if row and row[0] else []
-
-        # Base category flags
-        cur.execute(
-            "SELECT blocked FROM categories WHERE name=?",
-            ("Global Block All",),
+        # Global allowlist + base flags/schedules for Global Block All and the matched category
+        allowlist, rows = _load_block_rules(
+            conn.cursor(), ("Global Block All", result["category"])
         )
-        row = cur.fetchone()
-        global_block_on = bool(row and row[0])
 
-        cur.execute(
-            "SELECT blocked, block_url FROM categories WHERE name=?",
-            (result["category"],),
-        )
-        row = cur.fetchone()
-        cat_blocked = bool(row[0]) if row else False
-        cat_block_url = row[1] if row else None
-
-        # --- Apply schedule overrides, if configured ---
-        # Global Block All schedule
-        cur.execute(
-            "SELECT schedule_json FROM category_schedules WHERE name=?",
-            ("Global Block All",),
-        )
-        srow = cur.fetchone()
-        if srow and srow[0]:
-            try:
-                sched = json.loads(srow[0])
-            except Exception:
-                sched = None
-            if sched:
-                active = _is_schedule_active(sched)
-                # When a schedule exists, it controls whether Global Block All is on.
-                global_block_on = bool(active)
-
-        # Per-category schedule
-        cur.execute(
-            "SELECT schedule_json FROM category_schedules WHERE name=?",
-            (result["category"],),
-        )
-        srow = cur.fetchone()
-        if srow and srow[0]:
-            try:
-                sched = json.loads(srow[0])
-            except Exception:
-                sched = None
-            if sched:
-                active = _is_schedule_active(sched)
-                # When a schedule exists, it controls whether this category is blocked.
-                cat_blocked = bool(active)
+    return jsonify(
+        _block_decision(url, result, allowlist, rows, default_redirect, time.time())
+    )
 
-    # --- Handle Global Block All Mode (unchanged, except schedule support) ---
-    allowed_domains = ["blocked.gdistrict.org"]
-    if global_block_on:
-        # Check if URL is in allowlist or allowed domains
-        allowed = any(a.lower() in url.lower() for a in allowlist + allowed_domains)
-        if not allowed:
-            return jsonify(
-                {
-                    "ok": True,
-                    "url": url,
-                    "result": result,
-                    "blocked": True,
-                    "block_url": default_redirect,
-                }
-            )
+# Page fetches dominate classify latency; a batch fans them out over the pooled session
+BATCH_MAX_URLS = 100
+BATCH_MAX_FETCHES = 10  # URLs without caller html that a signed-out caller can make us fetch per request
+_BATCH_POOL = ThreadPoolExecutor(max_workers=16, thread_name_prefix="classify")
 
-    # --- Normal AI blocking with (maybe) scheduled flag ---
-    blocked = cat_blocked
-    final_block_url = cat_block_url or default_redirect
+@ai.route("/classify/batch", methods=["POST"])
+def api_classify_batch():
+    """
+    Classify many URLs in one call: {"urls": [...], "html": [...]?} -> {"results": [...]} in request order.
+    "html", when given, lines up with "urls" (null where there is none). Each result has the same shape as /classify.
+    """
+    body = _body()
+    urls = body.get("urls")
+    if not isinstance(urls, list) or not all(isinstance(u, str) for u in urls):
+        return jsonify({"ok": False, "error": "urls must be a list of strings"}), 400
+    if len(urls) > BATCH_MAX_URLS:
+        return jsonify({"ok": False, "error": f"too many urls (max {BATCH_MAX_URLS})"}), 400
+    htmls = body.get("html")
+    if htmls is None:
+        htmls = [None] * len(urls)
+    elif (not isinstance(htmls, list) or len(htmls) != len(urls)
+          or not all(h is None or isinstance(h, str) for h in htmls)):
+        return jsonify({"ok": False, "error": "html must be a list of strings/null matching urls"}), 400
+    # every entry without html is a server-side page fetch; don't let anonymous callers fan those out
+    if not session.get("user") and sum(1 for h in htmls if not h) > BATCH_MAX_FETCHES:
+        return jsonify({"ok": False, "error": f"at most {BATCH_MAX_FETCHES} urls without html unless signed in"}), 400
+
+    results = list(_BATCH_POOL.map(classify_cached, urls, htmls))
 
-    return jsonify(
-        {
-            "ok": True,
-            "url": url,
-            "result": result,
-            "blocked": blocked,
-            "block_url": final_block_url,
-        }
+    default_redirect = get_setting(
+        "blocked_redirect",
+        "https://blocked.gdistrict.org/Gschool%20block",
     )
+    with _db() as conn:
+        allowlist, rows = _load_block_rules(conn.cursor())
+
+    now_ts = time.time()
+    return jsonify({
+        "ok": True,
+        "results": [
+            _block_decision(u, r, allowlist, rows, default_redirect, now_ts)
+            for u, r in zip(urls, results)
+        ],
+    })
 
 @ai.route("/chat/send", methods=["POST"])
 def chat_send():
-    ensure_schema()
-    b = request.json or {}
+    b = _body()
     room = b.get("room") or "*"
     user_id = b.get("user_id") or "unknown"
     role = b.get("role") or "student"
     text = (b.get("text") or "").strip()[:1000]
     if not text:
         return jsonify({"ok": False, "error": "empty"}), 400
-    ts = int(time.time() * 1000)
+    ts = time.time_ns() // 1_000_000
     with _db() as conn:
         cur = conn.cursor()
         cur.execute("INSERT INTO chat_messages(room,user_id,role,text,ts) VALUES(?,?,?,?,?)",
@@ -336,7 +425,6 @@ def chat_send():
 
 @ai.route("/chat/poll", methods=["GET"])
 def chat_poll():
-    ensure_schema()
     room = request.args.get("room", "*")
     since = int(request.args.get("since", "0") or 0)
     with _db() as conn:
@@ -2,19 +2,85 @@
 # G-SCHOOLS CONNECT BACKEND
 # =========================
 
-from flask import Flask, request, jsonify, render_template, session, redirect, url_for
+from flask import Flask, request, jsonify, render_template, session, redirect, url_for, g, send_from_directory
 from flask_cors import CORS
-import json, os, time, sqlite3, traceback, uuid, re
-from urllib.parse import urlparse
+from werkzeug.security import generate_password_hash, check_password_hash
+import json, os, time, sqlite3, traceback, uuid, re, threading, queue, hmac, atexit
+import base64, binascii, hashlib, mimetypes
+from urllib.parse import urlparse, urlencode
 from datetime import datetime
-from collections import defaultdict
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+from itertools import count
+
+try:
+    from flask_compress import Compress  # optional br/gzip for the big JSON polls (/api/policy etc.)
+except ImportError:
+    Compress = None
+
+try:
+    import ahocorasick  # optional C automaton for category URL patterns
+except ImportError:
+    ahocorasick = None
+
+try:
+    import orjson  # optional faster JSON for state, settings and responses
+    def _jloads(s):
+        return orjson.loads(s)
+    def _jdumps(v):
+        return orjson.dumps(v).decode()
+    def _jdump_file(v):
+        return orjson.dumps(v, default=_deque_default, option=orjson.OPT_NON_STR_KEYS)
+    def _jdump_pretty(v):
+        return orjson.dumps(v, option=orjson.OPT_INDENT_2)
+except ImportError:
+    orjson = None
+    _jloads, _jdumps = json.loads, json.dumps
+    def _jdump_file(v):
+        return json.dumps(v, separators=(",", ":"), default=_deque_default).encode("utf-8")
+    def _jdump_pretty(v):
+        return json.dumps(v, indent=2).encode("utf-8")
+
+def _deque_default(o):
+    # capped logs are kept as deques in memory and stored as plain lists
+    if isinstance(o, deque):
+        return list(o)
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
 
 # ---------------------------
 # Flask App Initialization
 # ---------------------------
 app = Flask(__name__, static_url_path="/static", static_folder="static", template_folder="templates")
 app.secret_key = os.environ.get("SECRET_KEY", "dev_secret_key")
+
+from flask.json.provider import DefaultJSONProvider
+
+def _json_default(o):
+    if isinstance(o, deque):
+        return list(o)
+    return DefaultJSONProvider.default(o)
+
+class StateJSONProvider(DefaultJSONProvider):
+    """jsonify()/request.json, through orjson when installed; same sorted keys as Flask's default."""
+    default = staticmethod(_json_default)
+
+    if orjson is not None:
+        _opts = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS
+
+        def dumps(self, obj, **kwargs):
+            return orjson.dumps(obj, default=self.default, option=self._opts).decode()
+
+        def loads(self, s, **kwargs):
+            return orjson.loads(s)
+
+app.json = StateJSONProvider(app)
 CORS(app, resources={r"/api/*": {"origins": "*"}})
+if Compress is not None:
+    # policy/state JSON is repetitive and compresses ~10x; tiny replies aren't worth the CPU
+    app.config.setdefault("COMPRESS_ALGORITHM", ["br", "gzip"])
+    app.config.setdefault("COMPRESS_MIN_SIZE", 1024)
+    Compress(app)
 
 def _ice_servers():
     # Always include Google STUN
@@ -36,6 +102,7 @@ ROOT = os.path.dirname(__file__)
 DATA_PATH = os.path.join(ROOT, "data.json")
 DB_PATH = os.path.join(ROOT, "gschool.db")
 SCENES_PATH = os.path.join(ROOT, "scenes.json")
+SHOTS_DIR = os.path.join(ROOT, "screenshots")
 
 
 # =========================
@@ -44,9 +111,56 @@ SCENES_PATH = os.path.join(ROOT, "scenes.json")
 
 def db():
     """Open sqlite connection (row factory stays default to keep light)."""
-    con = sqlite3.connect(DB_PATH)
+    con = sqlite3.connect(DB_PATH, check_same_thread=False)
+    # per-connection settings; pooled connections keep them (and their statement cache).
+    # journal_mode=WAL is persistent and set once in _init_db.
+    con.executescript(
+        "PRAGMA synchronous=NORMAL;"
+        "PRAGMA temp_store=MEMORY;"
+        "PRAGMA mmap_size=268435456;"
+        "PRAGMA cache_size=-20000;"
+    )
     return con
 
+# Idle connections are parked here between requests instead of being reopened each time
+DB_POOL_MAX = 8
+_DB_POOL = queue.SimpleQueue()
+
+def get_db():
+    """Connection for the current app context; handed back to the pool on teardown."""
+    if "db" not in g:
+        try:
+            g.db = _DB_POOL.get_nowait()
+        except queue.Empty:
+            g.db = db()
+    return g.db
+
+def _release_db(con):
+    if con.in_transaction:
+        con.rollback()
+    if _DB_POOL.qsize() < DB_POOL_MAX:
+        _DB_POOL.put(con)
+    else:
+        con.close()
+
+@app.teardown_appcontext
+def close_db(exc):
+    con = g.pop("db", None)
+    if con is not None:
+        _release_db(con)
+
+@contextmanager
+def pooled_db():
+    """Borrow a pooled connection outside a request (flush threads, atexit)."""
+    try:
+        con = _DB_POOL.get_nowait()
+    except queue.Empty:
+        con = db()
+    try:
+        yield con
+    finally:
+        _release_db(con)
+
 def _init_db():
     """Create tables if missing; repair structure when possible."""
     con = db()
@@ -74,11 +188,171 @@ def _init_db():
             ts INTEGER
         );
     """)
+    # DM reads are always one room in ts order
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_chat_room_ts ON chat_messages(room, ts)")
+    cur.execute("CREATE INDEX IF NOT EXISTS ix_chat_room_id ON chat_messages(room, id)")
+    # Salted password hashes; the plaintext `password` column is only read to
+    # upgrade legacy rows on their next successful login.
+    cols = {r[1] for r in cur.execute("PRAGMA table_info(users)")}
+    if "password_hash" not in cols:
+        cur.execute("ALTER TABLE users ADD COLUMN password_hash TEXT")
+    # Per-student and time-series state lives here instead of data.json, so a
+    # heartbeat writes a few rows rather than rewriting the whole blob.
+    cur.execute("PRAGMA journal_mode=WAL")
+    # history used to be keyed on (student, ts), so two navigations in the same second
+    # replaced each other; move old rows into the id-keyed table created below
+    hist_cols = {r[1] for r in cur.execute("PRAGMA table_info(history)")}
+    rebuild_history = bool(hist_cols) and "id" not in hist_cols
+    if rebuild_history:
+        cur.execute("DROP INDEX IF EXISTS ix_history_ts")
+        cur.execute("ALTER TABLE history RENAME TO history_old")
+    new_shot_refs = not cur.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='shot_files'").fetchone()
+    cur.executescript("""
+        CREATE TABLE IF NOT EXISTS presence (
+            student TEXT PRIMARY KEY,
+            last_seen INTEGER,
+            tabs_open INTEGER,
+            json TEXT
+        );
+        CREATE TABLE IF NOT EXISTS history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            student TEXT,
+            ts INTEGER,
+            url TEXT,
+            title TEXT,
+            fav TEXT
+        );
+        CREATE INDEX IF NOT EXISTS ix_history_ts ON history(ts);
+        CREATE INDEX IF NOT EXISTS ix_history_student_ts ON history(student, ts);
+        CREATE TABLE IF NOT EXISTS screenshots (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            student TEXT,
+            ts INTEGER,
+            tab_id,
+            data_url TEXT,
+            title TEXT,
+            url TEXT
+        );
+        CREATE INDEX IF NOT EXISTS ix_screenshots_student ON screenshots(student, id);
+        CREATE TABLE IF NOT EXISTS offtask_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            student TEXT,
+            url TEXT,
+            ts INTEGER,
+            on_task INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS ix_offtask_ts ON offtask_events(ts);
+        CREATE INDEX IF NOT EXISTS ix_offtask_student_ts ON offtask_events(student, ts);
+        CREATE TABLE IF NOT EXISTS alerts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts INTEGER,
+            student TEXT,
+            kind TEXT,
+            score REAL,
+            title TEXT,
+            url TEXT,
+            note TEXT
+        );
+        CREATE INDEX IF NOT EXISTS ix_alerts_ts ON alerts(ts);
+        CREATE INDEX IF NOT EXISTS ix_alerts_student_ts ON alerts(student, ts);
+        CREATE TABLE IF NOT EXISTS pending_commands (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            target TEXT,
+            type TEXT,
+            cmd TEXT
+        );
+        CREATE INDEX IF NOT EXISTS ix_pending_commands_target ON pending_commands(target, id);
+        CREATE TABLE IF NOT EXISTS student_pending (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            student TEXT,
+            item TEXT
+        );
+        CREATE INDEX IF NOT EXISTS ix_student_pending_student ON student_pending(student, id);
+        CREATE TABLE IF NOT EXISTS audit (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts INTEGER,
+            event TEXT,
+            json TEXT
+        );
+        -- /shots/ files referenced by screenshot rows and presence (screenshot + tabshots);
+        -- the triggers keep refs current and _gc_shots() unlinks files that reach 0
+        CREATE TABLE IF NOT EXISTS shot_files (
+            name TEXT PRIMARY KEY,
+            refs INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS ix_shot_files_unref ON shot_files(name) WHERE refs <= 0;
+        CREATE TRIGGER IF NOT EXISTS tr_screenshots_ref AFTER INSERT ON screenshots
+        WHEN NEW.data_url LIKE '/shots/%' BEGIN
+            INSERT INTO shot_files(name, refs) VALUES (NEW.data_url, 1)
+            ON CONFLICT(name) DO UPDATE SET refs = refs + 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS tr_screenshots_unref AFTER DELETE ON screenshots
+        WHEN OLD.data_url LIKE '/shots/%' BEGIN
+            UPDATE shot_files SET refs = refs - 1 WHERE name = OLD.data_url;
+        END;
+        CREATE TRIGGER IF NOT EXISTS tr_presence_ref AFTER INSERT ON presence BEGIN
+            INSERT INTO shot_files(name, refs)
+            SELECT name, COUNT(*) FROM (
+                SELECT json_extract(NEW.json, '$.screenshot') AS name
+                UNION ALL SELECT value FROM json_each(NEW.json, '$.tabshots'))
+            WHERE name LIKE '/shots/%' GROUP BY name
+            ON CONFLICT(name) DO UPDATE SET refs = refs + excluded.refs;
+        END;
+        CREATE TRIGGER IF NOT EXISTS tr_presence_reref AFTER UPDATE OF json ON presence BEGIN
+            INSERT INTO shot_files(name, refs)
+            SELECT name, COUNT(*) FROM (
+                SELECT json_extract(NEW.json, '$.screenshot') AS name
+                UNION ALL SELECT value FROM json_each(NEW.json, '$.tabshots'))
+            WHERE name LIKE '/shots/%' GROUP BY name
+            ON CONFLICT(name) DO UPDATE SET refs = refs + excluded.refs;
+            UPDATE shot_files SET refs = refs - (
+                SELECT COUNT(*) FROM (
+                    SELECT json_extract(OLD.json, '$.screenshot') AS name
+                    UNION ALL SELECT value FROM json_each(OLD.json, '$.tabshots'))
+                WHERE name = shot_files.name)
+            WHERE name IN (
+                SELECT json_extract(OLD.json, '$.screenshot')
+                UNION ALL SELECT value FROM json_each(OLD.json, '$.tabshots'));
+        END;
+    """)
+    if rebuild_history:
+        cur.execute("""INSERT INTO history(student, ts, url, title, fav)
+                       SELECT student, ts, url, title, fav FROM history_old ORDER BY ts, student""")
+        cur.execute("DROP TABLE history_old")
+    if new_shot_refs:
+        # first run with refcounts: count what is already referenced, and queue every
+        # file on disk at refs 0 so unreferenced leftovers are collected too
+        cur.execute("""INSERT INTO shot_files(name, refs)
+                       SELECT name, COUNT(*) FROM (
+                           SELECT data_url AS name FROM screenshots
+                           UNION ALL SELECT json_extract(json, '$.screenshot') FROM presence
+                           UNION ALL SELECT t.value FROM presence, json_each(presence.json, '$.tabshots') AS t)
+                       WHERE name LIKE '/shots/%' GROUP BY name""")
+        for dirpath, _, files in os.walk(SHOTS_DIR):
+            cur.executemany("INSERT OR IGNORE INTO shot_files(name, refs) VALUES(?, 0)",
+                            [("/shots/" + os.path.relpath(os.path.join(dirpath, f), SHOTS_DIR).replace(os.sep, "/"),)
+                             for f in files if not f.endswith(".tmp")])
+    # last_seen/tabs_open sit in their own columns so dashboard scans never decode the blob
+    cols = {r[1] for r in cur.execute("PRAGMA table_info(presence)")}
+    if "tabs_open" not in cols:
+        cur.execute("ALTER TABLE presence ADD COLUMN tabs_open INTEGER")
+        cur.execute("""UPDATE presence SET tabs_open =
+                       CASE WHEN json_type(json, '$.tabs') = 'array' THEN json_array_length(json, '$.tabs') ELSE 0 END""")
     con.commit()
     con.close()
 
 _init_db()
 
+# Row caps (same limits the JSON lists used)
+HISTORY_CAP = 500
+SCREENSHOTS_CAP = 200
+OFFTASK_CAP = 2000
+ALERTS_CAP = 500
+PENDING_CAP = 500  # per target; nobody polling must not mean an ever-growing queue
+STUDENT_PENDING_CAP = 50
+AUDIT_CAP = 500
+
 def _safe_default_data():
     return {
         "settings": {"chat_enabled": False},
@@ -94,14 +368,7 @@ def _safe_default_data():
             }
         },
         "categories": {},
-        "pending_commands": {},
-        "pending_per_student": {},
-        "presence": {},
-        "history": {},
-        "screenshots": {},
-        "dm": {},
-        "alerts": [],
-        "audit": []
+        "dm": {}
     }
 
 def _coerce_to_dict(obj):
@@ -118,15 +385,15 @@ def _coerce_to_dict(obj):
     return _safe_default_data()
 
 def load_data():
-    """Load JSON with self-repair for common corruption patterns."""
+    """Load JSON with self-repair for common corruption patterns; the result always has ensure_keys() applied."""
     if not os.path.exists(DATA_PATH):
         d = _safe_default_data()
         save_data(d)
         return d
     try:
-        with open(DATA_PATH, "r", encoding="utf-8") as f:
-            obj = json.load(f)
-            return ensure_keys(_coerce_to_dict(obj))
+        with open(DATA_PATH, "rb") as f:
+            obj = _jloads(f.read())
+        return ensure_keys(_coerce_to_dict(obj))
     except json.JSONDecodeError as e:
         # Try simple auto-repair: merge stray blocks like "} {"
         try:
@@ -150,30 +417,81 @@ def load_data():
         print("[WARN] load_data failed; using defaults:", e)
         return ensure_keys(_safe_default_data())
 
+def _write_atomic(path, payload, durable=True):
+    """Write-then-rename so readers never see a half-written file; fsync unless durable=False."""
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp, "xb") as f:
+            f.write(payload)
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        # never leave a stray temp file behind (full disk, interrupted write)
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    if durable and hasattr(os, "O_DIRECTORY"):
+        # the rename itself lives in the directory; sync it too or a power cut can undo it
+        fd = os.open(os.path.dirname(path) or ".", os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
 def save_data(d):
     d = ensure_keys(_coerce_to_dict(d))
-    with open(DATA_PATH, "w", encoding="utf-8") as f:
-        json.dump(d, f, indent=2)
+    _write_atomic(DATA_PATH, _jdump_file(d))
+
+# Read-through copy of the settings table. Only set_setting() writes these keys and
+# gunicorn runs a single worker, so the copy never goes stale. Values are shared:
+# callers treat them as read-only.
+_SETTINGS_CACHE = {}
+_NO_ROW = object()
 
 def get_setting(key, default=None):
-    con = db(); cur = con.cursor()
-    cur.execute("SELECT v FROM settings WHERE k=?", (key,))
-    row = cur.fetchone()
-    con.close()
-    if not row:
-        return default
-    try:
-        return json.loads(row[0])
-    except Exception:
-        return row[0]
+    v = _SETTINGS_CACHE.get(key, _NO_ROW)
+    if v is _NO_ROW and key not in _SETTINGS_CACHE:
+        row = get_db().execute("SELECT v FROM settings WHERE k=?", (key,)).fetchone()
+        if row:
+            try:
+                v = _jloads(row[0])
+            except Exception:
+                v = row[0]
+        _SETTINGS_CACHE[key] = v
+    return default if v is _NO_ROW else v
 
 def set_setting(key, value):
-    con = db(); cur = con.cursor()
-    cur.execute("REPLACE INTO settings (k, v) VALUES (?,?)", (key, json.dumps(value)))
-    con.commit(); con.close()
+    raw = _jdumps(value)
+    con = get_db(); cur = con.cursor()
+    cur.execute("REPLACE INTO settings (k, v) VALUES (?,?)", (key, raw))
+    con.commit()
+    _SETTINGS_CACHE[key] = _jloads(raw)
 
 def current_user():
-    return session.get("user")
+    """Session user, looked up once per request."""
+    if "_user" not in g:
+        g._user = session.get("user")
+    return g._user
+
+def json_body():
+    """Request JSON (decoded once, through app.json), or {} when missing or malformed."""
+    return request.get_json(force=True, silent=True) or {}
+
+def require_role(*roles):
+    """403 JSON unless the session user has one of `roles`."""
+    def deco(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            u = current_user()
+            if not u or u.get("role") not in roles:
+                return jsonify({"ok": False, "error": "forbidden"}), 403
+            return fn(*args, **kwargs)
+        return wrapper
+    return deco
 
 def ensure_keys(d):
     d.setdefault("settings", {}).setdefault("chat_enabled", False)
@@ -187,30 +505,258 @@ def ensure_keys(d):
         "students": []
     })
     d.setdefault("categories", {})
-    d.setdefault("pending_commands", {})
-    d.setdefault("pending_per_student", {})
-    d.setdefault("presence", {})
-    d.setdefault("history", {})
-    d.setdefault("screenshots", {})
-    d.setdefault("alerts", [])
     d.setdefault("dm", {})
-    d.setdefault("audit", [])
+    if "dm_unread_counts" not in d:
+        # seeded once from the legacy per-message flags, then kept by send/mark_read
+        d["dm_unread_counts"] = {
+            s: sum(1 for m in (msgs or []) if isinstance(m, dict) and m.get("from") == "student" and m.get("unread", True))
+            for s, msgs in (d["dm"] if isinstance(d["dm"], dict) else {}).items()
+        }
     # also carry feature flags
     d.setdefault("extension_enabled", True)
     return d
 
+# data.json is held in memory for the life of the process. Handlers mutate the shared
+# dict and call mark_dirty(); a background thread writes it back at most every
+# STATE_FLUSH_EVERY seconds (and once more at exit) instead of once per request.
+STATE_FLUSH_EVERY = 0.25
+_STATE_LOCK = threading.RLock()
+_STATE_WAKE = threading.Event()
+_STATE = {"d": None, "dirty": False}
+
+def current_data():
+    """The shared in-memory data.json, loaded from disk on first use."""
+    d = _STATE["d"]
+    if d is None:
+        with _STATE_LOCK:
+            if _STATE["d"] is None:
+                _STATE["d"] = load_data()
+            d = _STATE["d"]
+    return d
+
+def mark_dirty():
+    """Schedule the shared state for the next write-behind flush."""
+    _STATE["dirty"] = True
+    _bump("data")
+    _STATE_WAKE.set()
+
+def _flush_state():
+    with _STATE_LOCK:
+        if not _STATE["dirty"] or _STATE["d"] is None:
+            return
+        _STATE["dirty"] = False
+        for _ in range(3):
+            try:
+                payload = _jdump_file(_STATE["d"])
+                break
+            except RuntimeError:
+                # a handler resized a dict mid-dump; take the snapshot again
+                continue
+        else:
+            _STATE["dirty"] = True
+            _STATE_WAKE.set()
+            return
+        # settings.durability = "relaxed" trades the fsync for fewer disk stalls in bursts
+        relaxed = (_STATE["d"].get("settings") or {}).get("durability") == "relaxed"
+        try:
+            _write_atomic(DATA_PATH, payload, durable=not relaxed)
+        except BaseException:
+            # still unsaved (ENOSPC, EIO): keep it dirty so the next round and atexit retry
+            _STATE["dirty"] = True
+            raise
+
+def _state_flusher():
+    while True:
+        _STATE_WAKE.wait()
+        time.sleep(STATE_FLUSH_EVERY)
+        _STATE_WAKE.clear()
+        try:
+            _flush_state()
+        except Exception as e:
+            print("[WARN] state flush failed:", e)
+            _STATE_WAKE.set()
+
+threading.Thread(target=_state_flusher, name="state-flush", daemon=True).start()
+atexit.register(_flush_state)
+
+@app.before_request
+def _stamp():
+    # one wall-clock read per request; every ts a handler writes agrees
+    g.now = time.time_ns() // 1_000_000_000
+
+_MS_ID_LOCK = threading.Lock()
+_MS_ID_LAST = [0]
+
+def _ms_id():
+    """Millisecond timestamp id, bumped past the last one so two made in the same ms don't collide."""
+    with _MS_ID_LOCK:
+        n = _MS_ID_LAST[0] = max(time.time_ns() // 1_000_000, _MS_ID_LAST[0] + 1)
+    return n
+
+def _capped(container, key, cap):
+    """container[key] as a deque(maxlen=cap); append() then drops the oldest entry itself."""
+    v = container.get(key)
+    if not isinstance(v, deque) or v.maxlen != cap:
+        v = container[key] = deque(v if isinstance(v, (list, deque)) else (), maxlen=cap)
+    return v
+
+# State-style commands: only the newest one matters, so queuing one drops any
+# still-pending command of the listed types for the same target.
+_SUPERSEDES = {
+    "policy_refresh": ("policy_refresh",),
+    "update_youtube_rules": ("update_youtube_rules",),
+    "exam_start": ("exam_start", "exam_end"),
+    "exam_end": ("exam_start", "exam_end"),
+}
+
+def push_cmd(target, cmd):
+    """Queue cmd for target ("*" = everyone); superseded state commands are dropped first."""
+    con = get_db()
+    with con:
+        cur = con.cursor()
+        stale = _SUPERSEDES.get(cmd.get("type"))
+        if stale:
+            cur.execute(f"DELETE FROM pending_commands WHERE target=? AND type IN ({','.join('?' * len(stale))})",
+                        (target, *stale))
+        cur.execute("INSERT INTO pending_commands(target, type, cmd) VALUES(?,?,?)",
+                    (target, cmd.get("type"), _jdumps(cmd)))
+        _cap_rows(cur, "pending_commands", "id", PENDING_CAP, target, col="target")
+
+def push_student(student, item):
+    """Queue item for the student's next /api/policy poll (newest STUDENT_PENDING_CAP kept)."""
+    con = get_db()
+    with con:
+        cur = con.cursor()
+        cur.execute("INSERT INTO student_pending(student, item) VALUES(?,?)", (student, _jdumps(item)))
+        _cap_rows(cur, "student_pending", "id", STUDENT_PENDING_CAP, student)
+
+def take_student_pending(student):
+    """Fetch-and-clear the student's queued items, oldest first."""
+    con = get_db()
+    # most polls find nothing; a plain read skips taking the write lock for them
+    if not con.execute("SELECT 1 FROM student_pending WHERE student=? LIMIT 1", (student,)).fetchone():
+        return []
+    with con:
+        rows = con.execute("DELETE FROM student_pending WHERE student=? RETURNING id, item", (student,)).fetchall()
+    rows.sort()
+    return [_jloads(item) for _, item in rows]
+
+# Change stamps behind the ETags on polled GETs. Writers _bump() a bucket after
+# mutating it; readers tag their reply with the stamps and answer 304 on a match.
+_BOOT_ID = uuid.uuid4().hex[:8]
+_VER_SEQ = count(1)
+_VERS = {}  # only _bump() writes; readers use .get(k, 0) so polling a new key adds nothing
+
+def _bump(*keys):
+    for k in keys:
+        _VERS[k] = next(_VER_SEQ)
+
+def _etag_json(keys, build):
+    """jsonify(build()) with an ETag from the buckets in `keys`; 304 without building when unchanged."""
+    tag = _BOOT_ID + "." + ".".join(str(_VERS.get(k, 0)) for k in keys)
+    if request.if_none_match.contains(tag):
+        resp = app.response_class(status=304)
+    else:
+        resp = jsonify(build())
+    resp.set_etag(tag)
+    return resp
+
 def log_action(entry):
+    # appended as one row; data.json (and everything keyed on its version) is left alone
     try:
-        d = ensure_keys(load_data())
-        log = d.setdefault("audit", [])
         entry = dict(entry or {})
-        entry["ts"] = int(time.time())
-        log.append(entry)
-        d["audit"] = log[-500:]
-        save_data(d)
+        entry["ts"] = g.now
+        con = get_db()
+        with con:
+            cur = con.cursor()
+            cur.execute("INSERT INTO audit(ts, event, json) VALUES(?,?,?)",
+                        (entry["ts"], entry.get("event"), _jdumps(entry)))
+            _cap_rows(cur, "audit", "id", AUDIT_CAP)
     except Exception:
         pass
 
+def _cap_rows(cur, table, key, cap, student=None, col="student"):
+    """Drop all but the newest `cap` rows of table (per `col` value when student is given)."""
+    if student is None:
+        cur.execute(
+            f"DELETE FROM {table} WHERE {key} < "
+            f"(SELECT {key} FROM {table} ORDER BY {key} DESC LIMIT 1 OFFSET ?)",
+            (cap - 1,))
+    else:
+        cur.execute(
+            f"DELETE FROM {table} WHERE {col}=? AND {key} < "
+            f"(SELECT {key} FROM {table} WHERE {col}=? ORDER BY {key} DESC LIMIT 1 OFFSET ?)",
+            (student, student, cap - 1))
+
+def _tabs_open(pres):
+    tabs = pres.get("tabs")
+    return len(tabs) if isinstance(tabs, list) else 0
+
+def _presence_all(cur):
+    return {s: _jloads(j) for s, j in cur.execute("SELECT student, json FROM presence")}
+
+# upsert rather than INSERT OR REPLACE so the shot_files UPDATE trigger sees the old row
+_PRESENCE_UPSERT = ("INSERT INTO presence(student, last_seen, tabs_open, json) VALUES(?,?,?,?) "
+                    "ON CONFLICT(student) DO UPDATE SET last_seen=excluded.last_seen, "
+                    "tabs_open=excluded.tabs_open, json=excluded.json")
+
+_SQL_STATE_KEYS = ("presence", "history", "screenshots", "offtask_events", "alerts", "pending_commands",
+                   "pending_per_student", "audit")
+
+def _migrate_json_state():
+    """One-time move of presence/history/screenshots/offtask_events/alerts/pending queues/audit out of data.json."""
+    d = load_data()
+    if not any(k in d for k in _SQL_STATE_KEYS):
+        # keep this parse as the in-memory copy; current_data() won't read the file again
+        _STATE["d"] = d
+        return
+    con = db()
+    try:
+        with con:
+            cur = con.cursor()
+            for student, pres in (d.get("presence") or {}).items():
+                if isinstance(pres, dict):
+                    cur.execute(_PRESENCE_UPSERT, (student, int(pres.get("last_seen") or 0), _tabs_open(pres), _jdumps(pres)))
+            for student, arr in (d.get("history") or {}).items():
+                cur.executemany(
+                    "INSERT INTO history(student, ts, url, title, fav) VALUES(?,?,?,?,?)",
+                    [(student, int(e.get("ts") or 0), e.get("url"), e.get("title"), e.get("favIconUrl"))
+                     for e in (arr or []) if isinstance(e, dict)])
+            for student, arr in (d.get("screenshots") or {}).items():
+                cur.executemany(
+                    "INSERT INTO screenshots(student, ts, tab_id, data_url, title, url) VALUES(?,?,?,?,?,?)",
+                    [(student, int(e.get("ts") or 0), e.get("tabId"), e.get("dataUrl"), e.get("title"), e.get("url"))
+                     for e in (arr or []) if isinstance(e, dict)])
+            cur.executemany(
+                "INSERT INTO offtask_events(student, url, ts, on_task) VALUES(?,?,?,?)",
+                [(e.get("student"), e.get("url"), int(e.get("ts") or 0), int(bool(e.get("on_task", True))))
+                 for e in (d.get("offtask_events") or []) if isinstance(e, dict)])
+            cur.executemany(
+                "INSERT INTO alerts(ts, student, kind, score, title, url, note) VALUES(?,?,?,?,?,?,?)",
+                [(int(a.get("ts") or 0), a.get("student"), a.get("kind"), float(a.get("score") or 0.0),
+                  a.get("title"), a.get("url"), a.get("note"))
+                 for a in (d.get("alerts") or []) if isinstance(a, dict)])
+            for target, arr in (d.get("pending_commands") or {}).items():
+                cur.executemany(
+                    "INSERT INTO pending_commands(target, type, cmd) VALUES(?,?,?)",
+                    [(target, c.get("type"), _jdumps(c)) for c in (arr or []) if isinstance(c, dict)])
+            for student, arr in (d.get("pending_per_student") or {}).items():
+                cur.executemany(
+                    "INSERT INTO student_pending(student, item) VALUES(?,?)",
+                    [(student, _jdumps(c)) for c in list(arr or [])[-STUDENT_PENDING_CAP:] if isinstance(c, dict)])
+            cur.executemany(
+                "INSERT INTO audit(ts, event, json) VALUES(?,?,?)",
+                [(int(e.get("ts") or 0), e.get("event"), _jdumps(e))
+                 for e in list(d.get("audit") or [])[-AUDIT_CAP:] if isinstance(e, dict)])
+    finally:
+        con.close()
+    for k in _SQL_STATE_KEYS:
+        d.pop(k, None)
+    save_data(d)
+    _STATE["d"] = d
+
+_migrate_json_state()
+
 
 # =========================
 # Guest handling helper
@@ -233,38 +779,96 @@ def _is_guest_identity(email: str, name: str) -> bool:
 # =========================
 # Scenes Helpers
 # =========================
-def _load_scenes():
+# The catalog changes rarely; the `current` pointer flips on every apply/clear, so it
+# lives in its own tiny file and an apply never rewrites the catalog.
+SCENES_CURRENT_PATH = os.path.join(ROOT, "scenes_current.json")
+_SCENES_CACHE = {"key": None, "obj": None, "by_id": {}}
+_SCENES_LOCK = threading.Lock()
+
+def _scenes_catalog():
+    """Parsed scenes.json, re-read only when the file changes on disk."""
     try:
-        with open(SCENES_PATH, "r", encoding="utf-8") as f:
-            obj = json.load(f)
-    except Exception:
-        obj = {"allowed": [], "blocked": [], "current": None}
-    obj.setdefault("allowed", [])
-    obj.setdefault("blocked", [])
-    obj.setdefault("current", None)
+        st = os.stat(SCENES_PATH)
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+    except OSError:
+        key = None
+    with _SCENES_LOCK:
+        if _SCENES_CACHE["obj"] is None or _SCENES_CACHE["key"] != key:
+            try:
+                with open(SCENES_PATH, "rb") as f:
+                    obj = _jloads(f.read())
+                if not isinstance(obj, dict):
+                    raise ValueError("scenes.json is not an object")
+            except Exception:
+                obj = {"allowed": [], "blocked": [], "current": None}
+            by_id = {}
+            for bucket in ("allowed", "blocked"):
+                for sc in obj.get(bucket) or []:
+                    if isinstance(sc, dict):
+                        by_id.setdefault(str(sc.get("id")), sc)
+            _SCENES_CACHE["key"], _SCENES_CACHE["obj"], _SCENES_CACHE["by_id"] = key, obj, by_id
+        return _SCENES_CACHE["obj"]
+
+def _scene_by_id(sid):
+    """Catalog scene with this id (allowed before blocked, first wins); shared, don't mutate."""
+    _scenes_catalog()
+    return _SCENES_CACHE["by_id"].get(str(sid))
+
+_CURRENT_SCENE = {"cur": (None, None)}
+
+def _load_current_scene():
+    """The applied scene pointer; the file is only re-read when it changes on disk."""
+    try:
+        st = os.stat(SCENES_CURRENT_PATH)
+    except FileNotFoundError:
+        # not split out yet: fall back to the pointer older scenes.json files carry
+        return _scenes_catalog().get("current")
+    except OSError:
+        return None
+    key = (st.st_ino, st.st_mtime_ns, st.st_size)
+    have, val = _CURRENT_SCENE["cur"]
+    if have != key:
+        try:
+            with open(SCENES_CURRENT_PATH, "rb") as f:
+                val = _jloads(f.read())
+        except Exception:
+            val = None
+        _CURRENT_SCENE["cur"] = (key, val)
+    return dict(val) if isinstance(val, dict) else val
+
+def _save_current_scene(cur):
+    _write_atomic(SCENES_CURRENT_PATH, _jdumps(cur).encode("utf-8"))
+
+def _load_scenes():
+    cat = _scenes_catalog()
+    # fresh containers per call; handlers mutate what they get back
+    obj = {k: v for k, v in cat.items() if k != "current"}
+    obj["allowed"] = [dict(s) for s in cat.get("allowed", [])]
+    obj["blocked"] = [dict(s) for s in cat.get("blocked", [])]
+    obj["current"] = _load_current_scene()
     return obj
 
+# Scene writers are load -> modify -> save over the whole catalog (and the current
+# pointer); running them one at a time keeps two overlapping edits from losing one.
+# One gunicorn worker, so a process lock covers every writer.
+_SCENES_WRITE_LOCK = threading.RLock()
+
+def _scenes_writer(fn):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        with _SCENES_WRITE_LOCK:
+            return fn(*args, **kwargs)
+    return wrapper
+
 def _save_scenes(obj):
     obj = obj or {}
     obj.setdefault("allowed", [])
     obj.setdefault("blocked", [])
     obj.setdefault("current", None)
-    with open(SCENES_PATH, "w", encoding="utf-8") as f:
-        json.dump(obj, f, indent=2)
-
-# =========================
-# AI CATEGORY ROUTES (BluePrint)
-# =========================
-
-from flask import Blueprint, request, jsonify
-from urllib.parse import urlencode
-import time
-import json
-import re
-
-from app import load_data, save_data, ensure_keys, current_user
-
-ai = Blueprint("ai", __name__)
+    cat = {k: v for k, v in obj.items() if k != "current"}
+    # stays indented: scenes.json is checked in and edited by hand
+    _write_atomic(SCENES_PATH, _jdump_pretty(cat))
+    _save_current_scene(obj["current"])
 
 # =========================
 # AI (optional blueprint)
@@ -275,130 +879,16 @@ try:
 except Exception as _e:
     print("AI routes not loaded:", _e)
 
-# ------------------------------------------
-# GET AI categories
-# ------------------------------------------
-@ai.route("/api/ai/categories", methods=["GET"])
-def ai_get_categories():
-    u = current_user()
-    if not u or u["role"] != "admin":
-        return jsonify({"ok": False, "error": "forbidden"}), 403
-        
-    d = ensure_keys(load_data())
-
-    out = []
-    for name, c in d.get("categories", {}).items():
-        out.append({
-            "id": name,
-            "name": name,
-            "urls": c.get("urls", []),
-            "ai_labels": c.get("ai_labels", []),
-            "blockPage": c.get("blockPage", "")
-        })
-
-    return jsonify({"ok": True, "categories": out})
-
-
-# ------------------------------------------
-# SAVE an AI category (used by Admin)
-# ------------------------------------------
-@ai.route("/api/ai/category/save", methods=["POST"])
-def ai_category_save():
-    u = current_user()
-    if not u or u["role"] != "admin":
-        return jsonify({"ok": False, "error": "forbidden"}), 403
-
-    body = request.json or {}
-    name = body.get("name")
-    urls = body.get("urls") or []
-    bp = body.get("blockPage") or ""
-
-    if not name:
-        return jsonify({"ok": False, "error": "name required"}), 400
-
-    d = ensure_keys(load_data())
-    d["categories"][name] = {
-        "urls": urls,
-        "ai_labels": body.get("ai_labels", []),
-        "blockPage": bp
-    }
-
-    save_data(d)
-    return jsonify({"ok": True})
-
-
-# ------------------------------------------
-# DELETE AI category
-# ------------------------------------------
-@ai.route("/api/ai/delete", methods=["POST"])
-def ai_category_delete():
-    u = current_user()
-    if not u or u["role"] != "admin":
-        return jsonify({"ok": False, "error": "forbidden"}), 403
-
-    body = request.json or {}
-    name = body.get("name")
-
-    d = ensure_keys(load_data())
-    if name in d["categories"]:
-        del d["categories"][name]
-        save_data(d)
-
-    return jsonify({"ok": True})
-
-
-# ------------------------------------------
-# EXTENSION → classify URL against categories
-# ------------------------------------------
-@ai.route("/api/ai/classify", methods=["POST"])
-def ai_classify():
-    body = request.json or {}
-    url = (body.get("url") or "").strip()
-
-    if not url:
-        return jsonify({"ok": False, "error": "no url"}), 400
-
-    d = ensure_keys(load_data())
-    cats = d.get("categories", {})
-
-    matched = None
-    reason = None
-
-    for name, cat in cats.items():
-        for pat in cat.get("urls", []):
-            if pat and pat.lower() in url.lower():
-                matched = name
-                reason = f"Matched pattern: {pat}"
-                break
-        if matched:
-            break
-
-    if not matched:
-        return jsonify({"ok": True, "blocked": False})
-
-    block_page = cats[matched].get("blockPage") or "category_block"
-
-    params = {
-        "url": url,
-        "policy": matched,
-        "rule": matched,
-        "path": block_page,
-        "bypass": 1
-    }
-
-    block_url = "https://blocked.gdistrict.org/Gschool%20block?" + urlencode(params)
-
-    return jsonify({
-        "ok": True,
-        "blocked": True,
-        "category": matched,
-        "reason": reason,
-        "redirect": block_url
-    })
-
 # =========================
 # Pages
 # =========================
+_HEALTH_TMPL = '{"ok":true,"ts":%d}\n'
+
+@app.route("/health")
+def health():
+    # load balancer probe: no session, state or JSON provider involved
+    return app.response_class(_HEALTH_TMPL % g.now, mimetype="application/json")
+
 @app.route("/")
 def index():
     u = current_user()
@@ -415,14 +905,14 @@ def admin_page():
     u = current_user()
     if not u or u["role"] != "admin":
         return redirect(url_for("login_page"))
-    return render_template("admin.html", data=load_data(), user=u)
+    return render_template("admin.html", data=current_data(), user=u)
 
 @app.route("/teacher")
 def teacher_page():
     u = current_user()
     if not u or u["role"] not in ("teacher", "admin"):
         return redirect(url_for("login_page"))
-    return render_template("teacher.html", data=load_data(), user=u)
+    return render_template("teacher.html", data=current_data(), user=u)
 
 @app.route("/logout")
 def logout():
@@ -434,21 +924,45 @@ def logout():
 # Teacher Presentation (WebRTC signaling via REST polling)
 # =========================
 
-PRESENT = defaultdict(lambda: {
-    "offers": {},
-    "answers": {},
-    "cand_v": defaultdict(list),
-    "cand_t": defaultdict(list),
-    "updated": int(time.time()),
-    "active": False
-})
+# "updated" is time.monotonic(); rooms idle longer than PRESENT_TTL are reaped
+PRESENT_TTL = 300
+PRESENT_REAP_EVERY = 60
+PRESENT_LOCK = threading.Lock()
+
+def _new_room():
+    return {
+        "offers": {},
+        "answers": {},
+        "cand_v": defaultdict(deque),
+        "cand_t": defaultdict(deque),
+        # per-room lock for the candidate queues; PRESENT_LOCK only guards room lookup
+        "lock": threading.Lock(),
+        "updated": time.monotonic(),
+        "active": False
+    }
+
+PRESENT = defaultdict(_new_room)
 
 def _clean_room(room):
     r = PRESENT.get(room)
     if not r:
         return
-    now = int(time.time())
-    r["updated"] = now
+    r["updated"] = time.monotonic()
+
+def _reap_present_rooms():
+    cutoff = time.monotonic() - PRESENT_TTL
+    with PRESENT_LOCK:
+        for room, r in list(PRESENT.items()):
+            if r["updated"] < cutoff:
+                PRESENT.pop(room, None)
+    _schedule_present_reaper()
+
+def _schedule_present_reaper():
+    t = threading.Timer(PRESENT_REAP_EVERY, _reap_present_rooms)
+    t.daemon = True
+    t.start()
+
+_schedule_present_reaper()
 
 @app.route("/teacher/present")
 def teacher_present_page():
@@ -459,7 +973,7 @@ def teacher_present_page():
     room = re.sub(r'[^a-zA-Z0-9_-]+', '', (u.get("email") or "classroom").split("@")[0])
     return render_template(
         "teacher_present.html",
-        data=load_data(),
+        data=current_data(),
         ice_servers=_ice_servers(),
         user=u,
         room=room,
@@ -473,21 +987,16 @@ def student_present_view(room):
 @app.route("/api/present/<room>/start", methods=["POST"])
 def api_present_start(room):
     room = re.sub(r'[^a-zA-Z0-9_-]+', '', room)
-    PRESENT[room]["active"] = True
-    PRESENT[room]["updated"] = int(time.time())
+    with PRESENT_LOCK:
+        PRESENT[room]["active"] = True
+        PRESENT[room]["updated"] = time.monotonic()
     return jsonify({"ok": True, "room": room})
 
 @app.route("/api/present/<room>/end", methods=["POST"])
 def api_present_end(room):
     room = re.sub(r'[^a-zA-Z0-9_-]+', '', room)
-    PRESENT[room] = {
-        "offers": {},
-        "answers": {},
-        "cand_v": defaultdict(list),
-        "cand_t": defaultdict(list),
-        "updated": int(time.time()),
-        "active": False
-    }
+    with PRESENT_LOCK:
+        PRESENT[room] = _new_room()
     return jsonify({"ok": True})
 
 @app.route("/api/present/<room>/status", methods=["GET"])
@@ -499,38 +1008,43 @@ def api_present_status(room):
 # Viewer posts offer and polls for answer
 @app.route("/api/present/<room>/viewer/offer", methods=["POST"])
 def api_present_viewer_offer(room):
-    body = request.json or {}
+    body = json_body()
     sdp = body.get("sdp")
     client_id = body.get("client_id") or str(uuid.uuid4())
     room = re.sub(r'[^a-zA-Z0-9_-]+', '', room)
-    r = PRESENT[room]
-    r["offers"][client_id] = sdp
-    r["updated"] = int(time.time())
+    with PRESENT_LOCK:
+        r = PRESENT[room]
+        r["offers"][client_id] = sdp
+        r["updated"] = time.monotonic()
     return jsonify({"ok": True, "client_id": client_id})
 
 @app.route("/api/present/<room>/offers", methods=["GET"])
 def api_present_offers(room):
     # Teacher polls for pending offers
     room = re.sub(r'[^a-zA-Z0-9_-]+', '', room)
-    offers = PRESENT[room]["offers"]
+    with PRESENT_LOCK:
+        offers = dict(PRESENT[room]["offers"])
+        # teacher polling keeps the room alive for the reaper
+        _clean_room(room)
     return jsonify({"ok": True, "offers": offers})
 
 @app.route("/api/present/<room>/answer/<client_id>", methods=["POST", "GET"])
 def api_present_answer(room, client_id):
     room = re.sub(r'[^a-zA-Z0-9_-]+', '', room)
     client_id = re.sub(r'[^a-zA-Z0-9_-]+', '', client_id)
-    r = PRESENT[room]
     if request.method == "POST":
-        body = request.json or {}
+        body = json_body()
         sdp = body.get("sdp")
-        r["answers"][client_id] = sdp
-        # once answered, remove offer (optional)
-        if client_id in r["offers"]:
-            del r["offers"][client_id]
-        r["updated"] = int(time.time())
+        with PRESENT_LOCK:
+            r = PRESENT[room]
+            r["answers"][client_id] = sdp
+            # once answered, remove offer (optional)
+            if client_id in r["offers"]:
+                del r["offers"][client_id]
+            r["updated"] = time.monotonic()
         return jsonify({"ok": True})
     else:
-        ans = r["answers"].get(client_id)
+        ans = PRESENT[room]["answers"].get(client_id)
         return jsonify({"ok": True, "answer": ans})
 
 # ICE candidates (trickle)
@@ -539,20 +1053,27 @@ def api_present_candidate(room, side, client_id):
     room = re.sub(r'[^a-zA-Z0-9_-]+', '', room)
     client_id = re.sub(r'[^a-zA-Z0-9_-]+', '', client_id)
     side = "viewer" if side.lower().startswith("v") else "teacher"
-    r = PRESENT[room]
-    bucket_from = r["cand_v"] if side == "viewer" else r["cand_t"]
-    bucket_to = r["cand_t"] if side == "viewer" else r["cand_v"]
     if request.method == "POST":
-        body = request.json or {}
+        body = json_body()
         cands = body.get("candidates") or []
+        with PRESENT_LOCK:
+            r = PRESENT[room]
+            r["updated"] = time.monotonic()
         if cands:
-            bucket_from[client_id].extend(cands)
-        r["updated"] = int(time.time())
+            bucket_from = r["cand_v"] if side == "viewer" else r["cand_t"]
+            with r["lock"]:
+                bucket_from[client_id].extend(cands)
         return jsonify({"ok": True})
     else:
-        # GET fetch and clear incoming candidates for this side
-        cands = bucket_to.get(client_id, [])
-        bucket_to[client_id] = []
+        # GET drains incoming candidates for this side
+        with PRESENT_LOCK:
+            r = PRESENT[room]
+        bucket_to = r["cand_t"] if side == "viewer" else r["cand_v"]
+        with r["lock"]:
+            q = bucket_to.get(client_id)
+            cands = list(q) if q else []
+            if q:
+                q.clear()
         return jsonify({"ok": True, "candidates": cands})
 
 @app.route("/api/present/<room>/diag", methods=["GET"])
@@ -572,81 +1093,82 @@ def api_present_diag(room):
 # User Admin (create/list/delete)
 # =========================
 @app.route("/api/users", methods=["GET", "POST"])
+@require_role("admin")
 def api_users():
-    u = current_user()
-    # only admins can manage users
-    if not u or u.get("role") != "admin":
-        return jsonify({"ok": False, "error": "forbidden"}), 403
-
-    con = db()
+    con = get_db()
     cur = con.cursor()
 
     if request.method == "GET":
         # (not used by the simplified admin.html, but handy for future)
         cur.execute("SELECT email, role FROM users ORDER BY email ASC")
         rows = cur.fetchall()
-        con.close()
         return jsonify({"ok": True, "users": [{"email": r[0], "role": r[1]} for r in rows]})
 
     # POST: create or update a user
-    body = request.json or {}
+    body = json_body()
     email = (body.get("email") or "").strip().lower()
     password = body.get("password") or ""
     role = (body.get("role") or "teacher").strip().lower()
 
     if not email:
-        con.close()
         return jsonify({"ok": False, "error": "email required"}), 400
-    if not password:
-        # allow role-only updates if needed
-        cur.execute("SELECT email FROM users WHERE email=?", (email,))
-        if not cur.fetchone():
-            con.close()
-            return jsonify({"ok": False, "error": "password required for new user"}), 400
-
     if password:
         cur.execute(
-            "REPLACE INTO users (email, password, role) VALUES (?,?,?)",
-            (email, password, role)
+            "REPLACE INTO users (email, password, password_hash, role) VALUES (?,?,?,?)",
+            (email, None, generate_password_hash(password), role)
         )
     else:
+        # allow role-only updates if needed; no row touched means no such user
         cur.execute("UPDATE users SET role=? WHERE email=?", (role, email))
+        if not cur.rowcount:
+            return jsonify({"ok": False, "error": "password required for new user"}), 400
 
     con.commit()
-    con.close()
     return jsonify({"ok": True})
 
 @app.route("/api/users/delete", methods=["POST"])
+@require_role("admin")
 def api_users_delete():
-    u = current_user()
-    if not u or u.get("role") != "admin":
-        return jsonify({"ok": False, "error": "forbidden"}), 403
-
-    body = request.json or {}
+    body = json_body()
     email = (body.get("email") or "").strip().lower()
     if not email:
         return jsonify({"ok": False, "error": "email required"}), 400
 
-    con = db()
+    con = get_db()
     cur = con.cursor()
     cur.execute("DELETE FROM users WHERE email=?", (email,))
     con.commit()
-    con.close()
     return jsonify({"ok": True})
 
 # =========================
 # Auth
 # =========================
+@lru_cache(maxsize=1)
+def _dummy_hash():
+    return generate_password_hash(uuid.uuid4().hex)
+
 @app.route("/api/login", methods=["POST"])
 def api_login():
-    body = request.json or request.form
+    body = json_body() or request.form
     email = (body.get("email") or "").strip().lower()
     pw = body.get("password") or ""
-    con = db(); cur = con.cursor()
-    cur.execute("SELECT email,role FROM users WHERE email=? AND password=?", (email, pw))
+    con = get_db(); cur = con.cursor()
+    cur.execute("SELECT email, role, password_hash, password FROM users WHERE email=?", (email,))
     row = cur.fetchone()
-    con.close()
-    if row:
+    ok = False
+    if not row:
+        # unknown email: still pay for one hash check so response time doesn't reveal it
+        check_password_hash(_dummy_hash(), pw)
+    elif row[2]:
+        ok = check_password_hash(row[2], pw)
+    elif row[3] is not None:
+        # legacy plaintext row: verify once, then store the hash and drop the plaintext
+        ok = hmac.compare_digest(row[3].encode(), pw.encode())
+        if ok:
+            cur.execute("UPDATE users SET password_hash=?, password=NULL WHERE email=?",
+                        (generate_password_hash(pw), row[0]))
+            con.commit()
+    if ok:
         session["user"] = {"email": row[0], "role": row[1]}
         return jsonify({"ok": True, "role": row[1]})
     return jsonify({"ok": False, "error": "Invalid credentials"}), 401
@@ -658,7 +1180,7 @@ def api_login():
 @app.route("/api/data")
 def api_data():
     """Compatibility wrapper used by teacher.html's loadData()."""
-    d = ensure_keys(load_data())
+    d = current_data()
     cls = d["classes"].get("period1", {})
     return jsonify({
         "settings": {
@@ -684,12 +1206,10 @@ def api_data():
     })
 
 @app.route("/api/settings", methods=["POST"])
+@require_role("admin")
 def api_settings():
-    u = current_user()
-    if not u or u["role"] != "admin":
-        return jsonify({"ok": False, "error": "forbidden"}), 403
-    d = ensure_keys(load_data())
-    b = request.json or {}
+    d = current_data()
+    b = json_body()
 
     # existing settings
     if "blocked_redirect" in b:
@@ -716,18 +1236,18 @@ def api_settings():
         if ttl > 1440:
             ttl = 1440
         d["settings"]["bypass_ttl_minutes"] = ttl
+    if "durability" in b:
+        d["settings"]["durability"] = "relaxed" if b["durability"] == "relaxed" else "strict"
 
-    save_data(d)
+    mark_dirty()
+    _bump("settings")
     return jsonify({"ok": True, "settings": d["settings"]})
 
 @app.route("/api/categories", methods=["POST"])
+@require_role("admin")
 def api_categories():
-    u = current_user()
-    if not u or u["role"] != "admin":
-        return jsonify({"ok": False, "error": "forbidden"}), 403
-
-    d = ensure_keys(load_data())
-    b = request.json or {}
+    d = current_data()
+    b = json_body()
     name = b.get("name")
     urls = b.get("urls", [])
     bp = b.get("blockPage", "")
@@ -735,33 +1255,32 @@ def api_categories():
         return jsonify({"ok": False, "error": "name required"}), 400
 
     d["categories"][name] = {"urls": urls, "blockPage": bp}
+    _bump("categories")
 
     # Policy changed → force refresh for all extensions
-    d.setdefault("pending_commands", {}).setdefault("*", []).append({
+    push_cmd("*", {
         "type": "policy_refresh"
     })
 
-    save_data(d)
+    mark_dirty()
     log_action({"event": "categories_update", "name": name})
     return jsonify({"ok": True})
 
 @app.route("/api/categories/delete", methods=["POST"])
+@require_role("admin")
 def api_categories_delete():
-    u = current_user()
-    if not u or u["role"] != "admin":
-        return jsonify({"ok": False, "error": "forbidden"}), 403
-
-    d = ensure_keys(load_data())
-    name = (request.json or {}).get("name")
+    d = current_data()
+    name = (json_body()).get("name")
     if name in d["categories"]:
         del d["categories"][name]
+        _bump("categories")
 
         # Policy changed → force refresh
-        d.setdefault("pending_commands", {}).setdefault("*", []).append({
+        push_cmd("*", {
             "type": "policy_refresh"
         })
 
-        save_data(d)
+        mark_dirty()
         log_action({"event": "categories_delete", "name": name})
     return jsonify({"ok": True})
 
@@ -769,12 +1288,48 @@ def api_categories_delete():
 # =========================
 # AI Category Helpers
 # =========================
+# Category URL patterns, rebuilt only when the "categories" stamp moves. Entries are
+# (lowered pattern, category, pattern) in dict/list order; with pyahocorasick one
+# automaton pass over the URL finds every hit and the earliest entry wins.
+_CAT_MATCH = {"ver": None, "pats": [], "auto": None}
+_CAT_MATCH_LOCK = threading.Lock()
+
+def _category_matcher():
+    ver = _VERS.get("categories", 0)
+    m = _CAT_MATCH
+    if m["ver"] != ver:
+        with _CAT_MATCH_LOCK:
+            if m["ver"] != ver:
+                pats = [(p.lower(), name, p)
+                        for name, cat in current_data().get("categories", {}).items()
+                        for p in cat.get("urls", []) if p and isinstance(p, str)]
+                auto = None
+                if ahocorasick is not None and pats:
+                    auto = ahocorasick.Automaton()
+                    for i, (lp, _, _) in enumerate(pats):
+                        if lp not in auto:
+                            auto.add_word(lp, i)
+                    auto.make_automaton()
+                m["pats"], m["auto"], m["ver"] = pats, auto, ver
+    return m
+
+def _match_category(url):
+    """(category name, pattern) of the first category pattern found in url, else None."""
+    m = _category_matcher()
+    pats, auto = m["pats"], m["auto"]
+    url_lc = url.lower()
+    if auto is not None:
+        i = min((i for _, i in auto.iter(url_lc)), default=None)
+        return None if i is None else pats[i][1:]
+    for lp, name, p in pats:
+        if lp in url_lc:
+            return name, p
+    return None
+
 @app.route("/api/ai/categories", methods=["GET"])
+@require_role("admin")
 def api_ai_categories():
-    u = current_user()
-    if not u or u["role"] != "admin":
-        return jsonify({"ok": False, "error": "forbidden"}), 403
-    d = ensure_keys(load_data())
+    d = current_data()
     cats = []
     for name, cat in d.get("categories", {}).items():
         cats.append({
@@ -788,32 +1343,19 @@ def api_ai_categories():
 
 @app.route("/api/ai/classify", methods=["POST"])
 def api_ai_classify():
-    body = request.json or {}
+    body = json_body()
     url = (body.get("url") or "").strip()
     if not url:
         return jsonify({"ok": False, "error": "no url"}), 400
 
-    d = ensure_keys(load_data())
-    cats = d.get("categories", {})
-
-    label = None
-    reason = None
-    matched_cat = None
-
     # Simple pattern-based match against category URL patterns
-    for name, cat in cats.items():
-        for pat in cat.get("urls", []):
-            if pat and pat.lower() in url.lower():
-                label = name
-                reason = f"Matched category pattern: {pat}"
-                matched_cat = cat
-                break
-        if label:
-            break
-
-    if not label:
+    hit = _match_category(url)
+    if not hit:
         # Not blocked by AI / category patterns
         return jsonify({"ok": True, "blocked": False})
+    label, pat = hit
+    reason = f"Matched category pattern: {pat}"
+    matched_cat = current_data().get("categories", {}).get(label)
 
     # Build block page URL using blockPage (your block page path) if set
     path = (matched_cat or {}).get("blockPage") or f"category_{label}"
@@ -839,13 +1381,10 @@ def api_ai_classify():
 # Class / Teacher Controls
 # =========================
 @app.route("/api/announce", methods=["POST"])
+@require_role("teacher", "admin")
 def api_announce():
-    u = current_user()
-    if not u or u["role"] not in ("teacher", "admin"):
-        return jsonify({"ok": False, "error": "forbidden"}), 403
-
-    d = ensure_keys(load_data())
-    body = request.json or {}
+    d = current_data()
+    body = json_body()
 
     msg = (
         (body.get("message") or "").strip()
@@ -856,23 +1395,23 @@ def api_announce():
     d["announcements"] = msg
 
     # Tell all extensions to re-fetch /api/policy so they see the new announcement
-    d.setdefault("pending_commands", {}).setdefault("*", []).append({
+    push_cmd("*", {
         "type": "policy_refresh"
     })
 
-    save_data(d)
+    mark_dirty()
     log_action({"event": "announce", "message": msg})
     return jsonify({"ok": True})
 
 @app.route("/api/class/set", methods=["GET", "POST"])
 def api_class_set():
-    d = ensure_keys(load_data())
+    d = current_data()
 
     if request.method == "GET":
         cls = d["classes"].get("period1", {})
         return jsonify({"class": cls, "settings": d["settings"]})
 
-    body = request.json or {}
+    body = json_body()
     cls = d["classes"].get("period1", {})
     prev_active = bool(cls.get("active", True))
 
@@ -900,36 +1439,34 @@ def api_class_set():
     d["classes"]["period1"] = cls
 
     if bool(cls.get("active", True)) and not prev_active:
-        d.setdefault("pending_commands", {}).setdefault("*", []).append({
+        push_cmd("*", {
             "type": "notify",
             "title": "Class session is active",
             "message": "Please join and stay until dismissed."
         })
 
     # IMPORTANT: force all extensions to re-fetch policy for new rules
-    d.setdefault("pending_commands", {}).setdefault("*", []).append({
+    push_cmd("*", {
         "type": "policy_refresh"
     })
 
-    save_data(d)
+    mark_dirty()
+    _bump("settings")
     log_action({"event": "class_set", "active": cls.get("active", True)})
     return jsonify({"ok": True, "class": cls, "settings": d["settings"]})
 
 @app.route("/api/class/toggle", methods=["POST"])
+@require_role("teacher", "admin")
 def api_class_toggle():
-    u = current_user()
-    if not u or u["role"] not in ("teacher", "admin"):
-        return jsonify({"ok": False, "error": "forbidden"}), 403
-
-    d = ensure_keys(load_data())
-    b = request.json or {}
+    d = current_data()
+    b = json_body()
     cid = b.get("class_id", "period1")
     key = b.get("key")
     val = bool(b.get("value"))
 
     if cid in d["classes"] and key in ("focus_mode", "paused"):
         d["classes"][cid][key] = val
-        save_data(d)
+        mark_dirty()
         log_action({"event": "class_toggle", "key": key, "value": val})
         return jsonify({"ok": True, "class": d["classes"][cid]})
 
@@ -940,43 +1477,40 @@ def api_class_toggle():
 # Commands
 # =========================
 @app.route("/api/command", methods=["POST"])
+@require_role("teacher", "admin")
 def api_command():
-    u = current_user()
-    if not u or u["role"] not in ("teacher", "admin"):
-        return jsonify({"ok": False, "error": "forbidden"}), 403
-    d = ensure_keys(load_data())
-    b = request.json or {}
+    b = json_body()
     target = b.get("student") or "*"
     cmd = b.get("command")
     if not cmd or "type" not in cmd:
         return jsonify({"ok": False, "error": "invalid"}), 400
-    d.setdefault("pending_commands", {}).setdefault(target, []).append(cmd)
-    save_data(d)
+    push_cmd(target, cmd)
     log_action({"event": "command", "target": target, "type": cmd.get("type")})
     return jsonify({"ok": True})
 
 @app.route("/api/commands/<student>", methods=["GET", "POST"])
 def api_commands(student):
-    d = ensure_keys(load_data())
-
     if request.method == "GET":
-        cmds = d["pending_commands"].get(student, []) + d["pending_commands"].get("*", [])
-        d["pending_commands"][student] = []
-        d["pending_commands"]["*"] = []
-        save_data(d)
-        return jsonify({"commands": cmds})
+        # Fetch-and-clear in one statement; the student's own queue comes before broadcasts
+        con = get_db()
+        with con:
+            rows = con.execute("DELETE FROM pending_commands WHERE target IN (?, '*') RETURNING target, id, cmd",
+                               (student,)).fetchall()
+        rows.sort(key=lambda r: (r[0] == "*", r[1]))
+        # cmd was encoded once when queued; splice the stored JSON instead of decode + re-encode
+        return app.response_class('{"commands":[' + ",".join(r[2] for r in rows) + "]}",
+                                  mimetype="application/json")
 
     # POST (push from teacher)
     u = current_user()
     if not u or u["role"] not in ("teacher", "admin"):
         return jsonify({"ok": False, "error": "forbidden"}), 403
 
-    b = request.json or {}
+    b = json_body()
     if not b.get("type"):
         return jsonify({"ok": False, "error": "missing type"}), 400
 
-    d["pending_commands"].setdefault(student, []).append(b)
-    save_data(d)
+    push_cmd(student, b)
     log_action({"event": "command_sent", "to": student, "cmd": b.get("type")})
     return jsonify({"ok": True})
 
@@ -984,21 +1518,43 @@ def api_commands(student):
 # =========================
 # Off-task Check (simple)
 # =========================
+_ALLOW_RE = re.compile(r"\*://\*\.(.+?)/\*")
+_BAD_KW_RE = re.compile(r"coolmath|roblox|twitch|steam|epicgames")
+
+@lru_cache(maxsize=4)
+def _scene_allowed(allowlist):
+    """Domains from '*://*.<domain>/*' patterns as a trie keyed on reversed labels (com -> example -> ...)."""
+    trie = {}
+    for p in allowlist:
+        if isinstance(p, str) and (m := _ALLOW_RE.match(p)):
+            node = trie
+            for label in reversed(m.group(1).lower().split(".")):
+                node = node.setdefault(label, {})
+            node[None] = True  # a domain ends here
+    return trie
+
+def _host_allowed(trie, host):
+    """True when host is an allowed domain or a subdomain of one; one dict hop per label."""
+    node = trie
+    for label in reversed(host.split(".")):
+        node = node.get(label)
+        if node is None:
+            return False
+        if None in node:
+            return True
+    return False
+
 @app.route("/api/offtask/check", methods=["POST"])
 def api_offtask_check():
-    b = request.json or {}
+    b = json_body()
     student = (b.get("student") or "").strip()
     url = (b.get("url") or "")
     if not student or not url:
         return jsonify({"ok": False}), 400
 
-    d = ensure_keys(load_data())
+    d = current_data()
     # allowlist from policy (scene) if any
-    scene_allowed = set()
-    for patt in (d.get("policy", {}).get("allowlist") or []):
-        m = re.match(r"\*\:\/\/\*\.(.+?)\/\*", patt)
-        if m:
-            scene_allowed.add(m.group(1).lower())
+    scene_allowed = _scene_allowed(tuple(d.get("policy", {}).get("allowlist") or ()))
 
     host = ""
     try:
@@ -1006,23 +1562,25 @@ def api_offtask_check():
     except Exception:
         pass
 
-    on_task = any(host.endswith(dom) for dom in scene_allowed) if host else False
-    bad_kw = ("coolmath", "roblox", "twitch", "steam", "epicgames")
-    if any(k in url.lower() for k in bad_kw):
+    on_task = bool(host and scene_allowed and _host_allowed(scene_allowed, host))
+    if _BAD_KW_RE.search(url.lower()):
         on_task = False
 
-    v = {"student": student, "url": url, "ts": int(time.time()), "on_task": bool(on_task)}
-    d.setdefault("offtask_events", []).append(v)
-    d["offtask_events"] = d["offtask_events"][-2000:]
-    save_data(d)
-
-    try:
-        # If using socketio, you could emit here; safely ignore if not present
-        from flask_socketio import SocketIO  # type: ignore
-        socketio = SocketIO(message_queue=None)
-        socketio.emit("offtask", v, broadcast=True)
-    except Exception:
-        pass
+    v = {"student": student, "url": url, "ts": g.now, "on_task": bool(on_task)}
+    con = get_db()
+    with con:
+        cur = con.cursor()
+        cur.execute("INSERT INTO offtask_events(student, url, ts, on_task) VALUES(?,?,?,?)",
+                    (student, url, v["ts"], int(v["on_task"])))
+        _cap_rows(cur, "offtask_events", "id", OFFTASK_CAP)
+
+    # Push to dashboards only if a SocketIO server was attached to the app (it registers itself here)
+    socketio = app.extensions.get("socketio")
+    if socketio is not None:
+        try:
+            socketio.emit("offtask", v)
+        except Exception:
+            pass
 
     return jsonify({"ok": True, "on_task": bool(on_task)})
 
@@ -1030,124 +1588,252 @@ def api_offtask_check():
 # =========================
 # Presence / Heartbeat
 # =========================
+# Heartbeats only touch these in-memory structures; a background thread
+# batches them into SQLite every HB_FLUSH_EVERY seconds. Readers call
+# _flush_heartbeats() first so they always see their own writes.
+HB_FLUSH_EVERY = 1.0
+_HB_LOCK = threading.Lock()
+_HB_FLUSH_LOCK = threading.Lock()
+_HB_WAKE = threading.Event()
+PRESENCE = {}              # student -> presence dict (write-back cache)
+DIRTY_STUDENTS = set()     # students whose presence row is stale in the DB
+_LAST_HIST = {}            # student -> (url, ts) of their newest history row
+HISTORY_Q = deque(maxlen=100_000)
+SHOTS_Q = deque(maxlen=10_000)
+# rows taken off the queues but not committed yet; retried first (guarded by _HB_FLUSH_LOCK)
+_HB_PENDING_HIST = []
+_HB_PENDING_SHOTS = []
+_SHOTS_FS_LOCK = threading.Lock()   # store_shot reuse vs _gc_shots unlink of the same file
+SHOT_GC_GRACE = 60                  # seconds; well past HB_FLUSH_EVERY
+
+def store_shot(data_url):
+    """Write a base64 data: URL once under SHOTS_DIR by content hash; returns its /shots/ URL.
+    Anything that isn't a base64 data URL (empty, already a URL) is returned unchanged."""
+    if not isinstance(data_url, str) or not data_url.startswith("data:"):
+        return data_url
+    header, _, payload = data_url.partition(",")
+    if not header.endswith(";base64"):
+        return data_url
+    try:
+        raw = base64.b64decode(payload)
+    except (ValueError, binascii.Error):
+        return data_url
+    h = hashlib.sha256(raw).hexdigest()
+    ext = mimetypes.guess_extension(header[5:-7]) or ".bin"
+    name = f"{h[:2]}/{h}{ext}"
+    path = os.path.join(SHOTS_DIR, name)
+    with _SHOTS_FS_LOCK:
+        try:
+            os.utime(path)
+            exists = True
+        except FileNotFoundError:
+            exists = False
+    if not exists:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(raw)
+        os.replace(tmp, path)
+    return "/shots/" + name
+
+@app.route("/shots/<path:name>")
+@require_role("teacher", "admin")
+def shot_file(name):
+    # content-addressed, so the bytes behind a name never change
+    resp = send_from_directory(SHOTS_DIR, name, max_age=31536000)
+    resp.cache_control.public = False
+    resp.cache_control.private = True
+    return resp
+
+def _presence_for(student):
+    pres = PRESENCE.get(student)
+    if pres is None:
+        row = get_db().execute("SELECT json FROM presence WHERE student=?", (student,)).fetchone()
+        pres = PRESENCE[student] = _jloads(row[0]) if row else {}
+    return pres
+
+def _last_history(student):
+    if student not in _LAST_HIST:
+        _LAST_HIST[student] = get_db().execute(
+            "SELECT url, ts FROM history WHERE student=? ORDER BY ts DESC, id DESC LIMIT 1", (student,)).fetchone()
+    return _LAST_HIST[student]
+
+def _flush_heartbeats():
+    with _HB_FLUSH_LOCK:
+        with _HB_LOCK:
+            pres_rows = [(s, PRESENCE[s].get("last_seen"), _tabs_open(PRESENCE[s]), _jdumps(PRESENCE[s]))
+                         for s in DIRTY_STUDENTS]
+            DIRTY_STUDENTS.clear()
+            _HB_PENDING_HIST.extend(HISTORY_Q); HISTORY_Q.clear()
+            _HB_PENDING_SHOTS.extend(SHOTS_Q); SHOTS_Q.clear()
+        hist_rows, shot_rows = _HB_PENDING_HIST, _HB_PENDING_SHOTS
+        if not (pres_rows or hist_rows or shot_rows):
+            return
+        try:
+            _write_heartbeats(pres_rows, hist_rows, shot_rows)
+        except BaseException:
+            # presence is rebuilt from PRESENCE; the queued rows stay pending, bounded like the queues
+            with _HB_LOCK:
+                DIRTY_STUDENTS.update(r[0] for r in pres_rows)
+            del hist_rows[:-HISTORY_Q.maxlen], shot_rows[:-SHOTS_Q.maxlen]
+            raise
+        hist_rows.clear()
+        shot_rows.clear()
+        _gc_shots()
+
+def _write_heartbeats(pres_rows, hist_rows, shot_rows):
+    with pooled_db() as con, con:
+        cur = con.cursor()
+        cur.executemany(_PRESENCE_UPSERT, pres_rows)
+        cur.executemany("INSERT INTO history(student, ts, url, title, fav) VALUES(?,?,?,?,?)", hist_rows)
+        cur.executemany(
+            "INSERT INTO screenshots(student, ts, tab_id, data_url, title, url) VALUES(?,?,?,?,?,?)", shot_rows)
+        for student in {r[0] for r in hist_rows}:
+            _cap_rows(cur, "history", "id", HISTORY_CAP, student)
+        for student in {r[0] for r in shot_rows}:
+            _cap_rows(cur, "screenshots", "id", SCREENSHOTS_CAP, student)
+
+def _gc_shots():
+    """Unlink /shots/ files no screenshot row or presence entry points at any more.
+    Runs under _HB_FLUSH_LOCK, the only writer of the tables that hold references."""
+    with pooled_db() as con:
+        names = [r[0] for r in con.execute("SELECT name FROM shot_files WHERE refs <= 0")]
+        gone = []
+        cutoff = time.time() - SHOT_GC_GRACE
+        for name in names:
+            path = os.path.join(SHOTS_DIR, name[len("/shots/"):])
+            with _SHOTS_FS_LOCK:
+                try:
+                    # a heartbeat may already hold this name for its next flush; store_shot
+                    # touches the file, so only collect ones nobody has produced lately
+                    if os.stat(path).st_mtime > cutoff:
+                        continue
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            gone.append((name,))
+        if gone:
+            with con:
+                con.executemany("DELETE FROM shot_files WHERE name=? AND refs <= 0", gone)
+
+def _heartbeat_flusher():
+    while True:
+        _HB_WAKE.wait()
+        time.sleep(HB_FLUSH_EVERY)
+        _HB_WAKE.clear()
+        try:
+            _flush_heartbeats()
+        except Exception as e:
+            print("[WARN] heartbeat flush failed:", e)
+            _HB_WAKE.set()  # unflushed rows are still pending; try again next round
+
+threading.Thread(target=_heartbeat_flusher, name="heartbeat-flush", daemon=True).start()
+atexit.register(_flush_heartbeats)
+
 @app.route("/api/heartbeat", methods=["POST"])
 def api_heartbeat():
     """Student heartbeat – updates presence, logs timeline, screenshots, and returns extension state."""
-    b = request.json or {}
+    b = json_body()
     student = (b.get("student") or "").strip()
     display_name = b.get("student_name", "")
 
     # Global kill switch (safe if file type changed)
-    data_global = ensure_keys(load_data())
+    data_global = current_data()
     extension_enabled_global = bool(data_global.get("extension_enabled", True))
 
     # Hard-disable guest/anonymous identities – do NOT log or persist anything
     if _is_guest_identity(student, display_name):
         return jsonify({
             "ok": True,
-            "server_time": int(time.time()),
+            "server_time": g.now,
             "extension_enabled": False  # completely disabled for guests
         })
 
-    d = ensure_keys(load_data())
-    d.setdefault("presence", {})
-
     if student:
-        pres = d["presence"].setdefault(student, {})
-        pres["last_seen"] = int(time.time())
-        pres["student_name"] = display_name
-        pres["tab"] = b.get("tab", {}) or {}
-        pres["tabs"] = b.get("tabs", []) or []
-        # support both camel and snake favicon key names
-        if "favIconUrl" in pres.get("tab", {}):
-            pass
-        elif "favicon" in pres.get("tab", {}):
-            pres["tab"]["favIconUrl"] = pres["tab"].get("favicon")
-
-        pres["screenshot"] = b.get("screenshot", "") or ""
-
-        # --- Keep only screenshots for open tabs shown in modal preview ---
-        shots = pres.get("tabshots", {})
-        for k, v in (b.get("tabshots", {}) or {}).items():
-            shots[str(k)] = v
-        open_ids = {str(t.get("id")) for t in pres["tabs"] if "id" in t}
-        for k in list(shots.keys()):
-            if k not in open_ids:
-                del shots[k]
-        pres["tabshots"] = shots
-        d["presence"][student] = pres
-
-        # ---------- Timeline & Screenshot history ----------
-        try:
-            timeline = d.setdefault("history", {}).setdefault(student, [])
-            now = int(time.time())
-            cur = pres.get("tab", {}) or {}
-            url = (cur.get("url") or "").strip()
-            title = (cur.get("title") or "").strip()
-            fav = cur.get("favIconUrl")
-
-            should_add = False
-            if url:
-                if not timeline:
-                    should_add = True
-                else:
-                    last = timeline[-1]
-                    if last.get("url") != url or now - int(last.get("ts", 0)) >= 15:
+        # decode/hash/write frames before taking the lock; only the references go in under it
+        screenshot = store_shot(b.get("screenshot", "") or "")
+        tabshots = b.get("tabshots")
+        tabshots = {str(k): store_shot(v) for k, v in tabshots.items()} if isinstance(tabshots, dict) else {}
+        # malformed extras are skipped, never a 500 that would drop the presence update
+        shot_log = b.get("shot_log")
+        shot_log = [(s.get("tabId"), store_shot(s.get("dataUrl")), (s.get("title") or ""), (s.get("url") or ""))
+                    for s in shot_log[:10] if isinstance(s, dict)] if isinstance(shot_log, list) else []
+        with _HB_LOCK:
+            pres = _presence_for(student)
+            pres["last_seen"] = g.now
+            pres["student_name"] = display_name
+            pres["tab"] = b.get("tab", {}) or {}
+            pres["tabs"] = b.get("tabs", []) or []
+            # support both camel and snake favicon key names
+            if "favIconUrl" in pres.get("tab", {}):
+                pass
+            elif "favicon" in pres.get("tab", {}):
+                pres["tab"]["favIconUrl"] = pres["tab"].get("favicon")
+
+            pres["screenshot"] = screenshot
+
+            # --- Keep only screenshots for open tabs shown in modal preview ---
+            shots = pres.get("tabshots", {})
+            shots.update(tabshots)
+            open_ids = {str(t.get("id")) for t in pres["tabs"] if "id" in t}
+            pres["tabshots"] = {k: v for k, v in shots.items() if k in open_ids}
+            DIRTY_STUDENTS.add(student)
+
+            # ---------- Timeline & Screenshot history ----------
+            try:
+                now = g.now
+                tab = pres.get("tab", {}) or {}
+                url = (tab.get("url") or "").strip()
+                title = (tab.get("title") or "").strip()
+                fav = tab.get("favIconUrl")
+
+                should_add = False
+                if url:
+                    last = _last_history(student)
+                    if not last or last[0] != url or now - int(last[1] or 0) >= 15:
                         should_add = True
 
-            if should_add:
-                timeline.append({"ts": now, "title": title, "url": url, "favIconUrl": fav})
-                d["history"][student] = timeline[-500:]  # cap
-
-            # Screenshot history: if extension passes `shot_log: [{tabId,dataUrl,title,url}]`
-            shot_log = b.get("shot_log") or []
-            if shot_log:
-                hist = d.setdefault("screenshots", {}).setdefault(student, [])
-                for s in shot_log[:10]:
-                    hist.append({
-                        "ts": now,
-                        "tabId": s.get("tabId"),
-                        "dataUrl": s.get("dataUrl"),
-                        "title": (s.get("title") or ""),
-                        "url": (s.get("url") or "")
-                    })
-                d["screenshots"][student] = hist[-200:]
-        except Exception as e:
-            print("[WARN] Heartbeat logging error:", e)
+                if should_add:
+                    HISTORY_Q.append((student, now, url, title, fav))
+                    _LAST_HIST[student] = (url, now)
 
-    save_data(d)
+                # Screenshot history: if extension passes `shot_log: [{tabId,dataUrl,title,url}]`
+                for tab_id, shot, s_title, s_url in shot_log:
+                    SHOTS_Q.append((student, now, tab_id, shot, s_title, s_url))
+            except Exception as e:
+                print("[WARN] Heartbeat logging error:", e)
+        _HB_WAKE.set()
 
     return jsonify({
         "ok": True,
-        "server_time": int(time.time()),
+        "server_time": g.now,
         # Honor global kill switch but also keep guest lockout enforced above.
         "extension_enabled": bool(extension_enabled_global)
     })
 
 @app.route("/api/presence")
+@require_role("teacher", "admin")
 def api_presence():
-    u = current_user()
-    if not u or u["role"] not in ("teacher", "admin"):
-        return jsonify({"ok": False, "error": "forbidden"}), 403
-    return jsonify(load_data().get("presence", {}))
+    _flush_heartbeats()
+    return jsonify(_presence_all(get_db().cursor()))
 
 
 # =========================
 # Extension Global Toggle
 # =========================
 @app.route("/api/extension/toggle", methods=["POST"])
+@require_role("teacher", "admin")
 def api_extension_toggle():
     """Toggle all student extensions (remote control by teacher/admin)."""
     user = current_user()
-    if not user or user.get("role") not in ("teacher", "admin"):
-        return jsonify({"ok": False, "error": "forbidden"}), 403
 
-    body = request.json or {}
+    body = json_body()
     enabled = bool(body.get("enabled", True))
 
-    data = ensure_keys(load_data())
+    data = current_data()
     data["extension_enabled"] = enabled
-    save_data(data)
+    mark_dirty()
+    _bump("extension")
 
     print(f"[INFO] Extension toggle → {'ENABLED' if enabled else 'DISABLED'} by {user.get('email')}")
     log_action({"event": "extension_toggle", "enabled": enabled, "by": user.get("email")})
@@ -1159,9 +1845,9 @@ def api_extension_toggle():
 # =========================
 @app.route("/api/policy", methods=["POST"])
 def api_policy():
-    b = request.json or {}
+    b = json_body()
     student = (b.get("student") or "").strip()
-    d = ensure_keys(load_data())
+    d = current_data()
     cls = d["classes"]["period1"]
 
     # Base flags
@@ -1174,63 +1860,70 @@ def api_policy():
     paused = bool(ov.get("paused", paused))
 
     # deliver any per-student pending commands (one-shot)
-    pending = d.get("pending_per_student", {}).get(student, []) if student else []
-    if student and student in d.get("pending_per_student", {}):
-        d["pending_per_student"].pop(student, None)
-        save_data(d)
+    pending = take_student_pending(student) if student else []
 
     # Scene merge logic (no over-blocking)
-    store = _load_scenes()
-    current = store.get("current") or None
+    current = _load_current_scene() or None
 
-    # Start with class-level lists
-    allowlist = list(cls.get("allowlist", []))
-    teacher_blocks = list(cls.get("teacher_blocks", []))
+    # Start with class-level lists (referenced, not copied: they are only serialized below)
+    allowlist = cls.get("allowlist", [])
+    teacher_blocks = cls.get("teacher_blocks", [])
 
     if current:
-        scene_obj = None
-        for bucket in ("allowed", "blocked"):
-            for s in store.get(bucket, []):
-                if str(s.get("id")) == str(current.get("id")):
-                    scene_obj = s
-                    break
-            if scene_obj:
-                break
-
+        scene_obj = _scene_by_id(current.get("id"))
         if scene_obj:
             if scene_obj.get("type") == "allowed":
                 # allow-only mode (focus true)
-                allowlist = list(scene_obj.get("allow", []))
+                allowlist = scene_obj.get("allow", [])
                 focus = True
             elif scene_obj.get("type") == "blocked":
-                # add extra teacher block patterns
-                teacher_blocks = (teacher_blocks or []) + list(scene_obj.get("block", []))
+                # add extra teacher block patterns; the one place a new list is needed
+                teacher_blocks = [*(teacher_blocks or ()), *scene_obj.get("block", ())]
 
     resp = {
-        "blocked_redirect": d.get("settings", {}).get(
-            "blocked_redirect",
-            "https://blocked.gdistrict.org/Gschool%20block"
-        ),
-        "categories": d.get("categories", {}),
         "focus_mode": bool(focus),
         "paused": bool(paused),
-        "announcement": d.get("announcements", ""),
-        "class": {
-            "id": "period1",
-            "name": cls.get("name", "Period 1"),
-            "active": bool(cls.get("active", True))
-        },
         "allowlist": allowlist,
         "teacher_blocks": teacher_blocks,
-        "chat_enabled": d.get("settings", {}).get("chat_enabled", False),
         "pending": pending,
-        "ts": int(time.time()),
+        "ts": g.now,
         "scenes": {"current": current},
-        # NEW: bypass flags for the extension
-        "bypass_enabled": bool(d.get("settings", {}).get("bypass_enabled", False)),
-        "bypass_ttl_minutes": int(d.get("settings", {}).get("bypass_ttl_minutes", 10)),
     }
-    return jsonify(resp)
+    # shared part first, then this student's fields spliced onto the same object
+    tail = app.json.dumps(resp)
+    return app.response_class(_policy_skeleton() + tail[1:] + "\n", mimetype="application/json")
+
+# The part of the policy reply that is the same for every student, encoded once per
+# change to data.json (mark_dirty bumps "data") and kept open-ended: '{...,'.
+_POLICY_SKEL = {"cur": (None, "")}
+
+def _policy_skeleton():
+    ver = _VERS.get("data", 0)
+    have, body = _POLICY_SKEL["cur"]
+    if have != ver:
+        d = current_data()
+        cls = d["classes"]["period1"]
+        settings = d.get("settings", {})
+        body = app.json.dumps({
+            "blocked_redirect": settings.get(
+                "blocked_redirect",
+                "https://blocked.gdistrict.org/Gschool%20block"
+            ),
+            "categories": d.get("categories", {}),
+            "announcement": d.get("announcements", ""),
+            "class": {
+                "id": "period1",
+                "name": cls.get("name", "Period 1"),
+                "active": bool(cls.get("active", True))
+            },
+            "chat_enabled": settings.get("chat_enabled", False),
+            # NEW: bypass flags for the extension
+            "bypass_enabled": bool(settings.get("bypass_enabled", False)),
+            "bypass_ttl_minutes": int(settings.get("bypass_ttl_minutes", 10)),
+        })
+        body = body[:-1] + ","
+        _POLICY_SKEL["cur"] = (ver, body)
+    return body
 
 
 @app.route("/api/bypass", methods=["POST"])
@@ -1239,8 +1932,8 @@ def api_bypass():
     Called by the block page / extension when a user enters the bypass code.
     Checks the code against admin settings and returns allow/deny.
     """
-    d = ensure_keys(load_data())
-    b = request.json or {}
+    d = current_data()
+    b = json_body()
     code = (b.get("code") or "").strip()
     url = (b.get("url") or "").strip()
     user = (b.get("user") or "").strip()
@@ -1250,7 +1943,7 @@ def api_bypass():
         return jsonify({"ok": False, "allow": False, "error": "disabled"}), 403
 
     expected = (settings.get("bypass_code") or "").strip()
-    if not expected or expected != code:
+    if not expected or not hmac.compare_digest(expected.encode(), code.encode()):
         return jsonify({"ok": False, "allow": False, "error": "invalid"}), 403
 
     # Optional: log bypass usage
@@ -1263,47 +1956,49 @@ def api_bypass():
 # Timeline & Screenshots
 # =========================
 @app.route("/api/timeline", methods=["GET"])
+@require_role("teacher", "admin")
 def api_timeline():
-    u = current_user()
-    if not u or u["role"] not in ("teacher", "admin"):
-        return jsonify({"ok": False, "error": "forbidden"}), 403
-    d = ensure_keys(load_data())
     student = (request.args.get("student") or "").strip()
     limit = max(1, min(int(request.args.get("limit", 200)), 1000))
     since = int(request.args.get("since", 0))
-    out = []
+    _flush_heartbeats()
+    con = get_db()
+    cur = con.cursor()
     if student:
-        out = [e for e in d.get("history", {}).get(student, []) if e.get("ts", 0) >= since]
-        out.sort(key=lambda x: x.get("ts", 0))
+        # newest `limit` entries, returned oldest first
+        cur.execute("""SELECT ts, title, url, fav FROM history WHERE student=? AND ts>=?
+                       ORDER BY ts DESC, id DESC LIMIT ?""", (student, since, limit))
+        out = [{"ts": ts, "title": t, "url": u, "favIconUrl": f} for (ts, t, u, f) in reversed(cur.fetchall())]
     else:
-        for s, arr in (d.get("history", {}) or {}).items():
-            for e in arr:
-                if e.get("ts", 0) >= since:
-                    out.append(dict(e, student=s))
-        out.sort(key=lambda x: x.get("ts", 0), reverse=True)
-    return jsonify({"ok": True, "items": out[-limit:]})
+        # newest first across the class
+        cur.execute("""SELECT student, ts, title, url, fav FROM history WHERE ts>=?
+                       ORDER BY ts DESC, id DESC LIMIT ?""", (since, limit))
+        out = [{"student": s, "ts": ts, "title": t, "url": u, "favIconUrl": f}
+               for (s, ts, t, u, f) in cur.fetchall()]
+    return jsonify({"ok": True, "items": out})
 
 @app.route("/api/screenshots", methods=["GET"])
+@require_role("teacher", "admin")
 def api_screenshots():
-    u = current_user()
-    if not u or u["role"] not in ("teacher", "admin"):
-        return jsonify({"ok": False, "error": "forbidden"}), 403
-    d = ensure_keys(load_data())
     student = (request.args.get("student") or "").strip()
     limit = max(1, min(int(request.args.get("limit", 100)), 500))
-    items = []
 
+    _flush_heartbeats()
+    con = get_db()
+    cur = con.cursor()
     if student:
-        items = list(d.get("screenshots", {}).get(student, []))
-        for it in items:
-            it.setdefault("student", student)
+        cur.execute("""SELECT student, ts, tab_id, data_url, title, url FROM screenshots WHERE student=?
+                       ORDER BY id DESC LIMIT ?""", (student, limit))
+        rows = cur.fetchall()[::-1]
     else:
-        for s, arr in (d.get("screenshots", {}) or {}).items():
-            for e in arr:
-                items.append(dict(e, student=s))
-        items.sort(key=lambda x: x.get("ts", 0), reverse=True)
+        # newest first across the class
+        cur.execute("""SELECT student, ts, tab_id, data_url, title, url FROM screenshots
+                       ORDER BY id DESC LIMIT ?""", (limit,))
+        rows = cur.fetchall()
+    items = [{"student": s, "ts": ts, "tabId": tid, "dataUrl": du, "title": t, "url": u}
+             for (s, ts, tid, du, t, u) in rows]
 
-    return jsonify({"ok": True, "items": items[-limit:]})
+    return jsonify({"ok": True, "items": items})
 
 
 # =========================
@@ -1311,15 +2006,14 @@ def api_screenshots():
 # =========================
 @app.route("/api/alerts", methods=["GET", "POST"])
 def api_alerts():
-    d = ensure_keys(load_data())
     if request.method == "POST":
-        b = request.json or {}
+        b = json_body()
         u = current_user()
         student = (b.get("student") or (u["email"] if (u and u.get("role") == "student") else "")).strip()
         if not student:
             return jsonify({"ok": False, "error": "student required"}), 400
         item = {
-            "ts": int(time.time()),
+            "ts": g.now,
             "student": student,
             "kind": b.get("kind", "off_task"),
             "score": float(b.get("score") or 0.0),
@@ -1327,31 +2021,36 @@ def api_alerts():
             "url": (b.get("url") or ""),
             "note": (b.get("note") or "")
         }
-        d.setdefault("alerts", []).append(item)
-        d["alerts"] = d["alerts"][-500:]
-        save_data(d)
+        con = get_db()
+        with con:
+            cur = con.cursor()
+            cur.execute("""INSERT INTO alerts(ts, student, kind, score, title, url, note)
+                           VALUES(:ts, :student, :kind, :score, :title, :url, :note)""", item)
+            _cap_rows(cur, "alerts", "id", ALERTS_CAP)
         log_action({"event": "alert", "student": student, "kind": item["kind"], "score": item["score"]})
         return jsonify({"ok": True})
 
     u = current_user()
     if not u or u["role"] not in ("teacher", "admin"):
         return jsonify({"ok": False, "error": "forbidden"}), 403
-    return jsonify({"ok": True, "items": d.get("alerts", [])[-200:]})
+    con = get_db()
+    cur = con.execute("SELECT ts, student, kind, score, title, url, note FROM alerts ORDER BY id DESC LIMIT 200")
+    cols = [c[0] for c in cur.description]
+    items = [dict(zip(cols, r)) for r in reversed(cur.fetchall())]
+    return jsonify({"ok": True, "items": items})
 
 
 @app.route("/api/alerts/clear", methods=["POST"])
+@require_role("teacher", "admin")
 def api_alerts_clear():
-    u = current_user()
-    if not u or u["role"] not in ("teacher", "admin"):
-        return jsonify({"ok": False, "error": "forbidden"}), 403
-    b = request.json or {}
+    b = json_body()
     student = (b.get("student") or "").strip()
-    d = ensure_keys(load_data())
-    if student:
-        d["alerts"] = [a for a in d.get("alerts", []) if a.get("student") != student]
-    else:
-        d["alerts"] = []
-    save_data(d)
+    con = get_db()
+    with con:
+        if student:
+            con.execute("DELETE FROM alerts WHERE student=?", (student,))
+        else:
+            con.execute("DELETE FROM alerts")
     return jsonify({"ok": True})
 
 
@@ -1359,14 +2058,12 @@ def api_alerts_clear():
 # Engagement API (NEW)
 # =========================
 @app.route("/api/engagement")
+@require_role("teacher", "admin")
 def api_engagement():
     """
     Simple engagement score per student over a time window.
     Query param: window (seconds) -> default 1800, min 60, max 14400.
     """
-    u = current_user()
-    if not u or u["role"] not in ("teacher", "admin"):
-        return jsonify({"ok": False, "error": "forbidden"}), 403
 
     try:
         window = int(request.args.get("window", 1800))
@@ -1374,36 +2071,33 @@ def api_engagement():
         window = 1800
     window = max(60, min(window, 14400))
 
-    now = int(time.time())
+    now = g.now
     since = now - window
 
-    d = ensure_keys(load_data())
-    presence = d.get("presence", {}) or {}
-    history = d.get("history", {}) or {}
-    off_events = d.get("offtask_events", []) or []
-    alerts = d.get("alerts", []) or []
-
-    students = set(presence.keys())
-    for student, arr in history.items():
-        if any((e.get("ts") or 0) >= since for e in (arr or [])):
-            students.add(student)
+    _flush_heartbeats()
+    con = get_db()
+    cur = con.cursor()
+    # only the two scalar columns; the per-student JSON blob is never decoded here
+    cur.execute("SELECT student, last_seen, tabs_open FROM presence")
+    presence = {s: (ls or 0, to or 0) for (s, ls, to) in cur.fetchall()}
+    # per-student counts inside the window, one grouped query per source
+    cur.execute("SELECT student, COUNT(*) FROM history WHERE ts>=? GROUP BY student", (since,))
+    hist_counts = dict(cur.fetchall())
+    cur.execute("SELECT student, COUNT(*) FROM offtask_events WHERE ts>=? AND on_task=0 GROUP BY student", (since,))
+    off_counts = dict(cur.fetchall())
+    cur.execute("SELECT student, COUNT(*) FROM alerts WHERE ts>=? GROUP BY student", (since,))
+    alert_counts = dict(cur.fetchall())
+
+    students = set(presence.keys()) | set(hist_counts.keys())
 
     results = []
     for student in sorted(students):
         if not student:
             continue
 
-        hist = [e for e in (history.get(student) or []) if (e.get("ts") or 0) >= since]
-        total_events = len(hist)
-
-        student_off = [
-            e for e in off_events
-            if (e.get("student") == student and (e.get("ts") or 0) >= since and not bool(e.get("on_task", True)))
-        ]
-        off_count = len(student_off)
-
-        student_alerts = [a for a in alerts if (a.get("student") == student and (a.get("ts") or 0) >= since)]
-        alerts_count = len(student_alerts)
+        total_events = hist_counts.get(student, 0)
+        off_count = off_counts.get(student, 0)
+        alerts_count = alert_counts.get(student, 0)
 
         if total_events > 0:
             ratio = off_count / float(total_events)
@@ -1417,8 +2111,7 @@ def api_engagement():
         if engagement < 0.4 or off_count >= 10 or alerts_count >= 5:
             risk = "high"
 
-        pres = presence.get(student) or {}
-        tabs_open = len(pres.get("tabs") or []) if isinstance(pres.get("tabs"), list) else 0
+        last_seen, tabs_open = presence.get(student, (0, 0))
 
         results.append({
             "student": student,
@@ -1426,7 +2119,7 @@ def api_engagement():
             "offtask_events": off_count,
             "alerts": alerts_count,
             "tabs_open": tabs_open,
-            "last_seen": pres.get("last_seen") or 0,
+            "last_seen": last_seen,
             "risk": risk
         })
 
@@ -1441,8 +2134,9 @@ def api_scenes_list():
     return jsonify(_load_scenes())
 
 @app.route("/api/scenes", methods=["POST"])
+@_scenes_writer
 def api_scenes_create():
-    body = request.json or {}
+    body = json_body()
     name = body.get("name")
     s_type = body.get("type")  # "allowed" or "blocked"
     if not name or s_type not in ("allowed", "blocked"):
@@ -1450,7 +2144,7 @@ def api_scenes_create():
 
     scenes = _load_scenes()
     new_scene = {
-        "id": str(int(time.time() * 1000)),
+        "id": str(_ms_id()),
         "name": name,
         "type": s_type,
         "allow": body.get("allow", []),
@@ -1464,8 +2158,9 @@ def api_scenes_create():
     return jsonify({"ok": True, "scene": new_scene})
 
 @app.route("/api/scenes/<sid>", methods=["PUT"])
+@_scenes_writer
 def api_scenes_update(sid):
-    body = request.json or {}
+    body = json_body()
     scenes = _load_scenes()
     updated = None
     for bucket in ("allowed", "blocked"):
@@ -1481,6 +2176,7 @@ def api_scenes_update(sid):
     return jsonify({"ok": True, "scene": updated})
 
 @app.route("/api/scenes/<sid>", methods=["DELETE"])
+@_scenes_writer
 def api_scenes_delete(sid):
     scenes = _load_scenes()
     for bucket in ("allowed", "blocked"):
@@ -1492,30 +2188,25 @@ def api_scenes_delete(sid):
     return jsonify({"ok": True})
 
 @app.route("/api/scenes/export", methods=["GET"])
+@require_role("teacher", "admin")
 def api_scenes_export():
-    u = current_user()
-    if not u or u["role"] not in ("teacher", "admin"):
-        return jsonify({"ok": False, "error": "forbidden"}), 403
-    store = _load_scenes()
     scene_id = request.args.get("id")
     if scene_id:
-        for bucket in ("allowed", "blocked"):
-            for s in store.get(bucket, []):
-                if s.get("id") == scene_id:
-                    return jsonify({"ok": True, "scene": s})
-        return jsonify({"ok": False, "error": "not found"}), 404
-    return jsonify({"ok": True, "scenes": store})
+        s = _scene_by_id(scene_id)
+        if s is None:
+            return jsonify({"ok": False, "error": "not found"}), 404
+        return jsonify({"ok": True, "scene": s})
+    return jsonify({"ok": True, "scenes": _load_scenes()})
 
 @app.route("/api/scenes/import", methods=["POST"])
+@require_role("teacher", "admin")
+@_scenes_writer
 def api_scenes_import():
-    u = current_user()
-    if not u or u["role"] not in ("teacher", "admin"):
-        return jsonify({"ok": False, "error": "forbidden"}), 403
-    body = request.json or {}
+    body = json_body()
     store = _load_scenes()
     if "scene" in body:
         sc = dict(body["scene"])
-        sc["id"] = sc.get("id") or ("scene_" + str(int(time.time() * 1000)))
+        sc["id"] = sc.get("id") or ("scene_" + str(_ms_id()))
         if sc.get("type") == "allowed":
             store.setdefault("allowed", []).append(sc)
         else:
@@ -1529,64 +2220,44 @@ def api_scenes_import():
     return jsonify({"ok": False, "error": "invalid payload"}), 400
 
 @app.route("/api/scenes/apply", methods=["POST"])
+@require_role("teacher", "admin")
+@_scenes_writer
 def api_scenes_apply():
-    u = current_user()
-    if not u or u["role"] not in ("teacher", "admin"):
-        return jsonify({"ok": False, "error": "forbidden"}), 403
-
-    body = request.json or {}
+    body = json_body()
     sid = body.get("id") or body.get("scene_id")
     disable = bool(body.get("disable", False))
 
-    store = _load_scenes()
-
     if disable:
-        store["current"] = None
-        _save_scenes(store)
+        _save_current_scene(None)
         log_action({"event": "scene_disabled"})
 
         # Policy changed → force refresh
-        d = ensure_keys(load_data())
-        d.setdefault("pending_commands", {}).setdefault("*", []).append({"type": "policy_refresh"})
-        save_data(d)
+        push_cmd("*", {"type": "policy_refresh"})
 
         return jsonify({"ok": True, "current": None})
 
     if not sid:
         return jsonify({"ok": False, "error": "scene_id required"}), 400
 
-    found = None
-    for bucket in ("allowed", "blocked"):
-        for s in store.get(bucket, []):
-            if str(s.get("id")) == str(sid):
-                found = {"id": s["id"], "name": s.get("name"), "type": s.get("type")}
-                break
-        if found:
-            break
-
-    if not found:
+    s = _scene_by_id(sid)
+    if not s:
         return jsonify({"ok": False, "error": "scene not found"}), 404
+    found = {"id": s["id"], "name": s.get("name"), "type": s.get("type")}
 
-    store["current"] = found
-    _save_scenes(store)
+    _save_current_scene(found)
     log_action({"event": "scene_applied", "scene": found})
 
     # Push a refresh command to all students
-    d = ensure_keys(load_data())
-    d.setdefault("pending_commands", {}).setdefault("*", []).append({"type": "policy_refresh"})
-    save_data(d)
+    push_cmd("*", {"type": "policy_refresh"})
     return jsonify({"ok": True, "current": found})
 
 @app.route("/api/scenes/clear", methods=["POST"])
+@_scenes_writer
 def api_scenes_clear():
-    scenes = _load_scenes()
-    scenes["current"] = None
-    _save_scenes(scenes)
+    _save_current_scene(None)
     log_action({"event": "scene_clear"})
 
-    d = ensure_keys(load_data())
-    d.setdefault("pending_commands", {}).setdefault("*", []).append({"type": "policy_refresh"})
-    save_data(d)
+    push_cmd("*", {"type": "policy_refresh"})
 
     return jsonify({"ok": True})
 
@@ -1594,9 +2265,48 @@ def api_scenes_clear():
 # =========================
 # Direct Messages
 # =========================
+# Sends are queued and a writer thread inserts them in batches, one transaction
+# (and one fsync) per batch. api_dm_me drains the queue first so reads see every send.
+DM_FLUSH_EVERY = 0.05
+DM_BATCH_MAX = 500
+_DM_FLUSH_LOCK = threading.Lock()
+_DM_WAKE = threading.Event()
+DM_Q = queue.SimpleQueue()
+_DM_PENDING = []   # batch taken off DM_Q but not committed yet; retried first (guarded by _DM_FLUSH_LOCK)
+
+def _flush_dms():
+    with _DM_FLUSH_LOCK:
+        while True:
+            batch = _DM_PENDING
+            while len(batch) < DM_BATCH_MAX:
+                try:
+                    batch.append(DM_Q.get_nowait())
+                except queue.Empty:
+                    break
+            if not batch:
+                return
+            with pooled_db() as con, con:
+                con.execute("BEGIN IMMEDIATE")
+                con.executemany("INSERT INTO chat_messages(room,user_id,role,text,ts) VALUES(?,?,?,?,?)", batch)
+            batch.clear()
+
+def _dm_writer():
+    while True:
+        _DM_WAKE.wait()
+        time.sleep(DM_FLUSH_EVERY)
+        _DM_WAKE.clear()
+        try:
+            _flush_dms()
+        except Exception as e:
+            print("[WARN] dm flush failed:", e)
+            _DM_WAKE.set()  # the batch is still in _DM_PENDING; try again next round
+
+threading.Thread(target=_dm_writer, name="dm-flush", daemon=True).start()
+atexit.register(_flush_dms)
+
 @app.route("/api/dm/send", methods=["POST"])
 def api_dm_send():
-    body = request.json or {}
+    body = json_body()
     u = current_user()
 
     if not u:
@@ -1623,12 +2333,14 @@ def api_dm_send():
     else:
         return jsonify({"ok": False, "error": "forbidden"}), 403
 
-    con = db(); cur = con.cursor()
-    cur.execute(
-        "INSERT INTO chat_messages(room,user_id,role,text,ts) VALUES(?,?,?,?,?)",
-        (room, user_id, role, text, int(time.time())),
-    )
-    con.commit(); con.close()
+    DM_Q.put((room, user_id, role, text, g.now))
+    _DM_WAKE.set()
+    _bump(room)
+    if role == "student":
+        counts = current_data()["dm_unread_counts"]
+        counts[user_id] = counts.get(user_id, 0) + 1
+        mark_dirty()
+        _bump("dm_unread")
     return jsonify({"ok": True})
 
 @app.route("/api/dm/me", methods=["GET"])
@@ -1644,39 +2356,48 @@ def api_dm_me():
     if not student:
         return jsonify({"ok": False, "error": "forbidden"}), 403
 
-    con = db(); cur = con.cursor()
-    cur.execute("SELECT user_id,role,text,ts FROM chat_messages WHERE room=? ORDER BY ts ASC", (f"dm:{student}",))
-    msgs = [{"from": r[1], "user": r[0], "text": r[2], "ts": r[3]} for r in cur.fetchall()]
-    con.close()
-    return jsonify(msgs)
+    room = f"dm:{student}"
+    # ?after=<id of the last message seen> returns only newer messages so pollers don't
+    # re-download the history; ids only grow, unlike ts which repeats within a second
+    after = request.args.get("after", 0, type=int)
+
+    def build():
+        _flush_dms()
+        cur = get_db().cursor()
+        cur.execute("SELECT id,user_id,role,text,ts FROM chat_messages WHERE room=? AND id>? ORDER BY id ASC",
+                    (room, after))
+        return [{"id": r[0], "from": r[2], "user": r[1], "text": r[3], "ts": r[4]} for r in cur.fetchall()]
+    return _etag_json((room,), build)
 
 @app.route("/api/dm/<student>", methods=["GET"])
 def api_dm_get(student):
     u = current_user()
     if not u:
         return jsonify({"ok": False, "error": "forbidden"}), 403
-    d = ensure_keys(load_data())
+    d = current_data()
     msgs = d.get("dm", {}).get(student, [])[-200:]
     return jsonify({"messages": msgs})
 
 @app.route("/api/dm/unread", methods=["GET"])
 def api_dm_unread():
-    d = ensure_keys(load_data())
-    out = {}
-    for student, msgs in d.get("dm", {}).items():
-        out[student] = sum(1 for m in msgs if m.get("from") == "student" and m.get("unread", True))
-    return jsonify(out)
+    return _etag_json(("dm_unread",), lambda: current_data()["dm_unread_counts"])
 
 @app.route("/api/dm/mark_read", methods=["POST"])
 def api_dm_mark_read():
-    body = request.json or {}
+    body = json_body()
     student = body.get("student")
-    d = ensure_keys(load_data())
-    if student in d.get("dm", {}):
-        for m in d["dm"][student]:
-            if m.get("from") == "student":
-                m["unread"] = False
-        save_data(d)
+    d = current_data()
+    changed = False
+    for m in d.get("dm", {}).get(student) or ():
+        if m.get("from") == "student" and m.get("unread", True):
+            m["unread"] = False
+            changed = True
+    if changed:
+        mark_dirty()
+    if d["dm_unread_counts"].get(student):
+        d["dm_unread_counts"][student] = 0
+        mark_dirty()
+        _bump("dm_unread")
     return jsonify({"ok": True})
 
 
@@ -1685,102 +2406,105 @@ def api_dm_mark_read():
 # =========================
 @app.route("/api/attention_check", methods=["POST"])
 def api_attention_check():
-    body = request.json or {}
+    body = json_body()
     title = body.get("title", "Are you paying attention?")
     timeout = int(body.get("timeout", 30))
 
-    d = ensure_keys(load_data())
-    d["attention_check"] = {"title": title, "timeout": timeout, "ts": int(time.time()), "responses": {}}
+    d = current_data()
+    d["attention_check"] = {"title": title, "timeout": timeout, "ts": g.now, "responses": {}}
+    _bump("attention")
 
-    d.setdefault("pending_commands", {}).setdefault("*", []).append({
+    push_cmd("*", {
         "type": "attention_check",
         "title": title,
         "timeout": timeout
     })
-    save_data(d)
+    mark_dirty()
     log_action({"event": "attention_check_start", "title": title})
     return jsonify({"ok": True})
 
 @app.route("/api/attention_response", methods=["POST"])
 def api_attention_response():
-    b = request.json or {}
+    b = json_body()
     student = (b.get("student") or "").strip()
     response = b.get("response", "")
-    d = ensure_keys(load_data())
+    d = current_data()
     check = d.get("attention_check")
     if not check:
         return jsonify({"ok": False, "error": "no active check"}), 400
-    check["responses"][student] = {"response": response, "ts": int(time.time())}
-    save_data(d)
+    check["responses"][student] = {"response": response, "ts": g.now}
+    mark_dirty()
+    _bump("attention")
     log_action({"event": "attention_response", "student": student, "response": response})
     return jsonify({"ok": True})
 
 @app.route("/api/attention_results")
 def api_attention_results():
-    d = ensure_keys(load_data())
-    return jsonify(d.get("attention_check", {}))
+    return _etag_json(("attention",), lambda: current_data().get("attention_check", {}))
 
 
 # =========================
 # Per-Student Controls
 # =========================
 @app.route("/api/student/set", methods=["POST"])
+@require_role("teacher", "admin")
 def api_student_set():
-    u = current_user()
-    if not u or u["role"] not in ("teacher", "admin"):
-        return jsonify({"ok": False, "error": "forbidden"}), 403
-    b = request.json or {}
+    b = json_body()
     student = (b.get("student") or "").strip()
     if not student:
         return jsonify({"ok": False, "error": "student required"}), 400
-    d = ensure_keys(load_data())
+    d = current_data()
     ov = d.setdefault("student_overrides", {}).setdefault(student, {})
     if "focus_mode" in b:
         ov["focus_mode"] = bool(b.get("focus_mode"))
     if "paused" in b:
         ov["paused"] = bool(b.get("paused"))
-    save_data(d)
+    mark_dirty()
     log_action({"event": "student_set", "student": student, "focus_mode": ov.get("focus_mode"), "paused": ov.get("paused")})
     return jsonify({"ok": True, "overrides": ov})
 
+_TAB_SCHEMES = ("http://", "https://")
+_URL_SCHEME_RE = re.compile(r"[a-z][a-z0-9+.-]*:(?!\d)")  # "host:8080" is a port, not a scheme
+
+def _tab_urls(urls):
+    """http(s) URLs only; whatever goes out here is opened on every targeted device.
+    A bare host ("khanacademy.org") gets https:// like classify() does; other schemes are dropped."""
+    if not isinstance(urls, list):
+        return []
+    out = []
+    for u in urls:
+        u = u.strip() if isinstance(u, str) else ""
+        low = u.lower()
+        if not u or (not low.startswith(_TAB_SCHEMES) and _URL_SCHEME_RE.match(low)):
+            continue
+        out.append(u if low.startswith(_TAB_SCHEMES) else "https://" + u)
+    return out
+
 @app.route("/api/open_tabs", methods=["POST"])
 def api_open_tabs_alias():
-    b = request.json or {}
-    urls = b.get("urls") or []
+    b = json_body()
+    urls = _tab_urls(b.get("urls"))
     student = (b.get("student") or "").strip()
     if not urls:
         return jsonify({"ok": False, "error": "urls required"}), 400
 
-    d = load_data()
-    d.setdefault("pending_commands", {})
     if student:
-        pend = d.setdefault("pending_per_student", {})
-        arr = pend.setdefault(student, [])
-        arr.append({"type": "open_tabs", "urls": urls, "ts": int(time.time())})
-        arr[:] = arr[-50:]
+        push_student(student, {"type": "open_tabs", "urls": urls, "ts": g.now})
         log_action({"event": "student_tabs", "student": student, "type": "open_tabs", "count": len(urls)})
     else:
-        d["pending_commands"].setdefault("*", []).append({"type": "open_tabs", "urls": urls, "ts": int(time.time())})
+        push_cmd("*", {"type": "open_tabs", "urls": urls, "ts": g.now})
         log_action({"event": "class_tabs", "target": "*", "type": "open_tabs", "count": len(urls)})
-    save_data(d)
     return jsonify({"ok": True})
 
 @app.route("/api/student/tabs_action", methods=["POST"])
+@require_role("teacher", "admin")
 def api_student_tabs_action():
-    u = current_user()
-    if not u or u["role"] not in ("teacher", "admin"):
-        return jsonify({"ok": False, "error": "forbidden"}), 403
-    b = request.json or {}
+    b = json_body()
     student = (b.get("student") or "").strip()
     action = (b.get("action") or "").strip()  # 'restore_tabs' | 'close_tabs'
     if not student or action not in ("restore_tabs", "close_tabs"):
         return jsonify({"ok": False, "error": "student and valid action required"}), 400
-    d = ensure_keys(load_data())
-    pend = d.setdefault("pending_per_student", {})
-    arr = pend.setdefault(student, [])
-    arr.append({"type": action, "ts": int(time.time())})
-    arr[:] = arr[-50:]
-    save_data(d)
+    push_student(student, {"type": action, "ts": g.now})
     log_action({"event": "student_tabs", "student": student, "type": action})
     return jsonify({"ok": True})
 
@@ -1790,19 +2514,26 @@ def api_student_tabs_action():
 # =========================
 @app.route("/api/chat/<class_id>", methods=["GET", "POST"])
 def api_chat(class_id):
-    d = ensure_keys(load_data())
-    d.setdefault("chat", {}).setdefault(class_id, [])
+    d = current_data()
     if request.method == "POST":
-        b = request.json or {}
+        b = json_body()
         txt = (b.get("text") or "")[:500]
         sender = b.get("from") or "student"
         if not txt:
             return jsonify({"ok": False, "error": "empty"}), 400
-        d["chat"][class_id].append({"from": sender, "text": txt, "ts": int(time.time())})
-        d["chat"][class_id] = d["chat"][class_id][-200:]
-        save_data(d)
+        _capped(d.setdefault("chat", {}), class_id, 200).append({"id": _ms_id(), "from": sender, "text": txt, "ts": g.now})
+        mark_dirty()
+        _bump("chat:" + class_id)
         return jsonify({"ok": True})
-    return jsonify({"enabled": d.get("settings", {}).get("chat_enabled", False), "messages": d["chat"][class_id][-100:]})
+    # ?after=<id of the last message seen> returns only newer messages so pollers don't re-download the backlog
+    after = request.args.get("after", type=int)
+
+    def build():
+        # reads must not create a room: any class_id can be polled
+        chat = d.get("chat", {}).get(class_id, ())
+        msgs = list(chat) if after is None else [m for m in chat if m.get("id", 0) > after]
+        return {"enabled": d.get("settings", {}).get("chat_enabled", False), "messages": msgs[-100:]}
+    return _etag_json(("chat:" + class_id, "settings"), build)
 
 
 # =========================
@@ -1810,61 +2541,63 @@ def api_chat(class_id):
 # =========================
 @app.route("/api/raise_hand", methods=["POST"])
 def api_raise_hand():
-    b = request.json or {}
+    b = json_body()
     student = (b.get("student") or "").strip()
     note = (b.get("note") or "").strip()
-    d = ensure_keys(load_data())
-    d.setdefault("raises", [])
-    d["raises"].append({"student": student, "note": note, "ts": int(time.time())})
-    d["raises"] = d["raises"][-200:]
-    save_data(d)
+    d = current_data()
+    _capped(d, "raises", 200).append({"student": student, "note": note, "ts": g.now})
+    mark_dirty()
+    _bump("raises")
     log_action({"event": "raise_hand", "student": student})
     return jsonify({"ok": True})
 
 @app.route("/api/raise_hand", methods=["GET"])
 def get_hands():
-    d = ensure_keys(load_data())
-    return jsonify({"hands": d.get("raises", [])})
+    return _etag_json(("raises",), lambda: {"hands": current_data().get("raises", [])})
 
 @app.route("/api/raise_hand/clear", methods=["POST"])
 def clear_hand():
-    b = request.json or {}
+    b = json_body()
     student = (b.get("student") or "").strip()
-    d = ensure_keys(load_data())
-    lst = d.get("raises", [])
+    d = current_data()
+    lst = _capped(d, "raises", 200)
     if student:
-        lst = [r for r in lst if r.get("student") != student]
+        lst = d["raises"] = deque((r for r in lst if r.get("student") != student), maxlen=200)
     else:
-        lst = []
-    d["raises"] = lst
-    save_data(d)
+        lst.clear()
+    mark_dirty()
+    _bump("raises")
     return jsonify({"ok": True, "remaining": len(lst)})
 
 
 # =========================
 # YouTube / Doodle settings
 # =========================
+def _norm_keywords(kws):
+    """Lowercased, stripped, deduped and sorted once at save time, so readers never re-normalize."""
+    return sorted({k.strip().lower() for k in (kws or []) if isinstance(k, str) and k.strip()})
+
 @app.route("/api/youtube_rules", methods=["GET", "POST"])
 def api_youtube_rules():
     if request.method == "POST":
-        body = request.json or {}
-        set_setting("yt_block_keywords", body.get("block_keywords", []))
+        body = json_body()
+        block_keywords = _norm_keywords(body.get("block_keywords"))
+        set_setting("yt_block_keywords", block_keywords)
         set_setting("yt_block_channels", body.get("block_channels", []))
         set_setting("yt_allow", body.get("allow", []))
         set_setting("yt_allow_mode", bool(body.get("allow_mode", False)))
+        _bump("yt")
 
         # Broadcast an update command to all present students
-        d = ensure_keys(load_data())
-        d.setdefault("pending_commands", {}).setdefault("*", []).append({
+        push_cmd("*", {
             "type": "update_youtube_rules",
             "rules": {
-                "block_keywords": body.get("block_keywords", []),
+                "block_keywords": block_keywords,
                 "block_channels": body.get("block_channels", []),
                 "allow": body.get("allow", []),
                 "allow_mode": bool(body.get("allow_mode", False))
             }
         })
-        save_data(d)
 
         log_action({"event": "youtube_rules_update"})
         return jsonify({"ok": True})
@@ -1880,7 +2613,7 @@ def api_youtube_rules():
 @app.route("/api/doodle_block", methods=["GET", "POST"])
 def api_doodle_block():
     if request.method == "POST":
-        body = request.json or {}
+        body = json_body()
         enabled = bool(body.get("enabled", False))
         set_setting("block_google_doodles", enabled)
         log_action({"event": "doodle_block_update", "enabled": enabled})
@@ -1893,28 +2626,27 @@ def api_doodle_block():
 # =========================
 @app.route("/api/overrides", methods=["GET"])
 def api_get_overrides():
-    d = ensure_keys(load_data())
-    return jsonify({
+    d = current_data()
+    return _etag_json(("overrides",), lambda: {
         "allowlist": d.get("allowlist", []),
         "teacher_blocks": d.get("teacher_blocks", [])
     })
 
 @app.route("/api/overrides", methods=["POST"])
+@require_role("admin")
 def api_save_overrides():
-    u = current_user()
-    if not u or u["role"] != "admin":
-        return jsonify({"ok": False, "error": "forbidden"}), 403
-    d = ensure_keys(load_data())
-    b = request.json or {}
+    d = current_data()
+    b = json_body()
     d["allowlist"] = b.get("allowlist", [])
     d["teacher_blocks"] = b.get("teacher_blocks", [])
+    _bump("overrides")
 
     # Policy changed → force refresh for all students
-    d.setdefault("pending_commands", {}).setdefault("*", []).append({
+    push_cmd("*", {
         "type": "policy_refresh"
     })
 
-    save_data(d)
+    mark_dirty()
     log_action({"event": "overrides_save"})
     return jsonify({"ok": True})
 
@@ -1923,42 +2655,40 @@ def api_save_overrides():
 # Poll
 # =========================
 @app.route("/api/poll", methods=["POST"])
+@require_role("teacher", "admin")
 def api_poll():
-    u = current_user()
-    if not u or u["role"] not in ("teacher", "admin"):
-        return jsonify({"ok": False, "error": "forbidden"}), 403
-    body = request.json or {}
+    body = json_body()
     q = (body.get("question") or "").strip()
     opts = [o.strip() for o in (body.get("options") or []) if o and o.strip()]
     if not q or not opts:
         return jsonify({"ok": False, "error": "question and options required"}), 400
-    poll_id = "poll_" + str(int(time.time() * 1000))
-    d = ensure_keys(load_data())
+    poll_id = "poll_" + str(_ms_id())
+    d = current_data()
     d.setdefault("polls", {})[poll_id] = {"question": q, "options": opts, "responses": []}
-    d.setdefault("pending_commands", {}).setdefault("*", []).append({
+    push_cmd("*", {
         "type": "poll", "id": poll_id, "question": q, "options": opts
     })
-    save_data(d)
+    mark_dirty()
     log_action({"event": "poll_create", "poll_id": poll_id})
     return jsonify({"ok": True, "poll_id": poll_id})
 
 @app.route("/api/poll_response", methods=["POST"])
 def api_poll_response():
-    b = request.json or {}
+    b = json_body()
     poll_id = b.get("poll_id")
     answer = b.get("answer")
     student = (b.get("student") or "").strip()
     if not poll_id:
         return jsonify({"ok": False, "error": "no poll id"}), 400
-    d = ensure_keys(load_data())
+    d = current_data()
     if poll_id not in d.get("polls", {}):
         return jsonify({"ok": False, "error": "unknown poll"}), 404
     d["polls"][poll_id].setdefault("responses", []).append({
         "student": student,
         "answer": answer,
-        "ts": int(time.time())
+        "ts": g.now
     })
-    save_data(d)
+    mark_dirty()
     log_action({"event": "poll_response", "poll_id": poll_id, "student": student})
     return jsonify({"ok": True})
 
@@ -1966,41 +2696,49 @@ def api_poll_response():
 # =========================
 # State (feature flags bucket)
 # =========================
+# settings keys /api/state (no auth) may expose
+_PUBLIC_SETTINGS = ("chat_enabled", "bypass_enabled", "bypass_ttl_minutes", "blocked_redirect")
+
 @app.route("/api/state")
 def api_state():
-    d = ensure_keys(load_data())
-    yt_rules = {
-        "block": get_setting("yt_block_keywords", []),
-        "allow": get_setting("yt_allow", []),
-        "allow_mode": bool(get_setting("yt_allow_mode", False))
-    }
-    features = d.setdefault("settings", {}).setdefault("features", {})
-    features["youtube_rules"] = yt_rules
-    features.setdefault("youtube_filter", True)
-    return jsonify(d)
+    def build():
+        d = current_data()
+        yt_rules = {
+            "block": get_setting("yt_block_keywords", []),
+            "allow": get_setting("yt_allow", []),
+            "allow_mode": bool(get_setting("yt_allow_mode", False))
+        }
+        settings = d.get("settings", {})
+        features = dict(settings.get("features") or {})
+        features["youtube_rules"] = yt_rules
+        features.setdefault("youtube_filter", True)
+        # flags only; DMs, audit, polls etc. stay server-side. Settings are copied key by
+        # key from an allowlist: the dict also holds secrets (passcode, bypass_code).
+        public = {k: settings[k] for k in _PUBLIC_SETTINGS if k in settings}
+        public["features"] = features
+        return {
+            "settings": public,
+            "features": features,
+            "yt_rules": yt_rules,
+            "extension_enabled": bool(d.get("extension_enabled", True)),
+            "exam_active": bool(d.get("exam_state", {}).get("active", False)),
+        }
+    return _etag_json(("settings", "yt", "extension", "exam"), build)
 
 
 # =========================
 # Student: open tabs (explicit)
 # =========================
 @app.route("/api/student/open_tabs", methods=["POST"])
+@require_role("teacher", "admin")
 def api_student_open_tabs():
-    u = current_user()
-    if not u or u["role"] not in ("teacher", "admin"):
-        return jsonify({"ok": False, "error": "forbidden"}), 403
-
-    b = request.json or {}
+    b = json_body()
     student = (b.get("student") or "").strip()
-    urls = b.get("urls") or []
+    urls = _tab_urls(b.get("urls"))
     if not student or not urls:
         return jsonify({"ok": False, "error": "student and urls required"}), 400
 
-    d = load_data()
-    pend = d.setdefault("pending_per_student", {})
-    arr = pend.setdefault(student, [])
-    arr.append({"type": "open_tabs", "urls": urls, "ts": int(time.time())})
-    arr[:] = arr[-50:]
-    save_data(d)
+    push_student(student, {"type": "open_tabs", "urls": urls, "ts": g.now})
     return jsonify({"ok": True})
 
 
@@ -2008,69 +2746,67 @@ def api_student_open_tabs():
 # Exam Mode
 # =========================
 @app.route("/api/exam", methods=["POST"])
+@require_role("teacher", "admin")
 def api_exam():
-    u = current_user()
-    if not u or u["role"] not in ("teacher", "admin"):
-        return jsonify({"ok": False, "error": "forbidden"}), 403
-    body = request.json or {}
+    body = json_body()
     action = (body.get("action") or "").strip()
     url = (body.get("url") or "").strip()
-    d = ensure_keys(load_data())
+    d = current_data()
     if action == "start":
         if not url:
             return jsonify({"ok": False, "error": "url required"}), 400
-        d.setdefault("pending_commands", {}).setdefault("*", []).append({"type": "exam_start", "url": url})
+        push_cmd("*", {"type": "exam_start", "url": url})
         d.setdefault("exam_state", {})["active"] = True
         d["exam_state"]["url"] = url
-        save_data(d)
+        mark_dirty()
+        _bump("exam")
         log_action({"event": "exam", "action": "start", "url": url})
         return jsonify({"ok": True})
     elif action == "end":
-        d.setdefault("pending_commands", {}).setdefault("*", []).append({"type": "exam_end"})
+        push_cmd("*", {"type": "exam_end"})
         d.setdefault("exam_state", {})["active"] = False
-        save_data(d)
+        mark_dirty()
+        _bump("exam")
         log_action({"event": "exam", "action": "end"})
         return jsonify({"ok": True})
     return jsonify({"ok": False, "error": "invalid action"}), 400
 
 @app.route("/api/exam_violation", methods=["POST"])
 def api_exam_violation():
-    b = request.json or {}
+    b = json_body()
     student = (b.get("student") or "").strip()
     url = (b.get("url") or "").strip()
     reason = (b.get("reason") or "tab_violation").strip()
     if not student:
         return jsonify({"ok": False, "error": "student required"}), 400
-    d = ensure_keys(load_data())
-    d.setdefault("exam_violations", []).append({
-        "student": student, "url": url, "reason": reason, "ts": int(time.time())
+    d = current_data()
+    _capped(d, "exam_violations", 500).append({
+        "student": student, "url": url, "reason": reason, "ts": g.now
     })
-    d["exam_violations"] = d["exam_violations"][-500:]
-    save_data(d)
+    mark_dirty()
+    _bump("exam_violations")
     log_action({"event": "exam_violation", "student": student, "reason": reason})
     return jsonify({"ok": True})
 
 @app.route("/api/exam_violations", methods=["GET"])
+@require_role("teacher", "admin")
 def api_exam_violations():
-    u = current_user()
-    if not u or u["role"] not in ("teacher", "admin"):
-        return jsonify({"ok": False, "error": "forbidden"}), 403
-    d = ensure_keys(load_data())
-    return jsonify({"ok": True, "items": d.get("exam_violations", [])[-200:]})
+    return _etag_json(("exam_violations",),
+                      lambda: {"ok": True, "items": list(current_data().get("exam_violations", []))[-200:]})
 
 @app.route("/api/exam_violations/clear", methods=["POST"])
+@require_role("teacher", "admin")
 def api_exam_violations_clear():
-    u = current_user()
-    if not u or u["role"] not in ("teacher", "admin"):
-        return jsonify({"ok": False, "error": "forbidden"}), 403
-    b = request.json or {}
+    b = json_body()
     student = (b.get("student") or "").strip()
-    d = ensure_keys(load_data())
+    d = current_data()
+    vs = _capped(d, "exam_violations", 500)
     if student:
-        d["exam_violations"] = [v for v in d.get("exam_violations", []) if v.get("student") != student]
+        d["exam_violations"] = deque((v for v in vs if v.get("student") != student), maxlen=500)
     else:
-        d["exam_violations"] = []
-    save_data(d)
+        vs.clear()
+    mark_dirty()
+    _bump("exam_violations")
     log_action({"event": "exam_violations_clear", "student": student or "*"})
     return jsonify({"ok": True})
 
@@ -2079,18 +2815,14 @@ def api_exam_violations_clear():
 # Notify
 # =========================
 @app.route("/api/notify", methods=["POST"])
+@require_role("teacher", "admin")
 def api_notify():
-    u = current_user()
-    if not u or u["role"] not in ("teacher", "admin"):
-        return jsonify({"ok": False, "error": "forbidden"}), 403
-    b = request.json or {}
+    b = json_body()
     title = (b.get("title") or "G School")[:120]
     message = (b.get("message") or "")[:500]
-    d = ensure_keys(load_data())
-    d.setdefault("pending_commands", {}).setdefault("*", []).append({
+    push_cmd("*", {
         "type": "notify", "title": title, "message": message
     })
-    save_data(d)
     log_action({"event": "notify", "title": title})
     return jsonify({"ok": True})
 
@@ -2101,18 +2833,16 @@ def api_notify():
 @app.route("/api/off_task", methods=["POST"])
 def api_off_task():
     try:
-        b = request.json or {}
+        b = json_body()
         student = (b.get("student") or "").strip()
         url = (b.get("url") or "").strip()
         reason = (b.get("reason") or "blocked_visit")
-        log_action({"event": "off_task", "student": student, "url": url, "reason": reason, "ts": int(time.time())})
-        d = ensure_keys(load_data())
-        d.setdefault("pending_commands", {}).setdefault("*", []).append({
+        log_action({"event": "off_task", "student": student, "url": url, "reason": reason, "ts": g.now})
+        push_cmd("*", {
             "type": "notify",
             "title": "Off-task detected",
             "message": f"{student or 'Student'} visited a blocked page."
         })
-        save_data(d)
         return jsonify({"ok": True})
     except Exception as e:
         try:
@@ -2126,6 +2856,9 @@ def api_off_task():
 # Run
 # =========================
 if __name__ == "__main__":
-    # Ensure data.json exists and is sane on boot
-    save_data(ensure_keys(load_data()))
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    # Ensure data.json exists and is sane on boot (from the copy already in memory)
+    save_data(current_data())
+    # Dev entry point only; production runs `gunicorn -c gunicorn.conf.py app:app`.
+    # No debugger/reloader unless asked for: the reloader imports the module twice.
+    app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)),
+            debug=os.environ.get("FLASK_DEBUG") == "1", threaded=True)
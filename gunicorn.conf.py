@@ -0,0 +1,23 @@
+# =========================
+# Gunicorn config (gunicorn -c gunicorn.conf.py app:app)
+# =========================
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+
+# Real threads, not green ones: sqlite and fsync calls block, which would stall
+# an eventlet hub, and threading.local (ai_routes._db) is per-greenlet under
+# eventlet so every request reconnected. Heartbeats/polls are short, so a
+# handful of threads covers them.
+worker_class = "gthread"
+threads = 8
+
+# Keep this at 1. Presence write-behind, present rooms and the classify
+# caches live in process memory; a second worker would see different state.
+workers = 1
+
+timeout = 60
+graceful_timeout = 10
+# Extensions poll every few seconds; gthread parks idle keep-alive sockets in
+# its poller (not a thread), which saves a reconnect (and TLS at the proxy) per poll.
+keepalive = 30